@@ -19,142 +19,401 @@
 # Peter Alping
 # peter@alping.se
 
-# Used for finding all the yaml files corresponding to the cards in the content folder and for logging
-import os, fnmatch, re, logging
+# Used for logging and for naming the files of split output
+import os, re, logging
 
-# Uses yaml to process yaml files with card information
-import yaml
-
-# Uses reportlab to generate the colour frame and the header/footer
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import cm
-
-# Uses pdfrw to include the contents of each card, saved as separate pdf:s
-from pdfrw import PdfReader
-from pdfrw.buildxobj import pagexobj
-from pdfrw.toreportlab import makerl
+# Used for caching imported card contents, in memory and on disk
+import io, collections, pickle, shelve, dbm
 
-# Load and return yaml data
-def yaml_loader(filepath):
-	with open(filepath, 'r') as file_descriptor:
-		data = yaml.load(file_descriptor)
-		file_descriptor.close()
-	return data
+# Used for building several pdf:s in parallel
+import time, threading, concurrent.futures
 
+# Used for the build manifests, that let unchanged pdf:s be skipped
+import hashlib
 
-# Dump yaml data to file
-def yaml_dump(filepath, data):
-	with open(filepath, 'w') as file_descriptor:
-		yaml.dump(data, file_descriptor)
-		file_descriptor.close()
+# Used for the manifests of split output
+import json
 
-def xtitle(string):
-		return string.title().replace('And', 'and')
+# Used for streaming large decks in chunks
+import itertools
 
-class MedRefCardFace():
-	"""Medical Reference Card Face"""
-	def __init__(self, header, content_path, footer, toc, references):
-		self.header = header
-		self.content_path = content_path
-		self.footer = footer
-		self.toc = toc
-		self.references = references
-
-	def __repr__(self):
-		return repr((self.header, self.content_path, self.footer, self.toc, self.references))
-
-
-class MedRefCard():
-	"""Medical Reference Card"""
-	def __init__(self, card_file):
-		card_dict = yaml_loader(card_file)
-
-		# Remove file name and .yml extention to create path
-		path_reg_ex = re.search(r'(?P<path>.*/).+\.yml', card_file)
-		# Remove file path and .yml extention to create filename
-		fn_reg_ex = re.search(r'.*/(?P<fn>.+)\.yml', card_file)
+# Uses yaml for the pre-rendered card face names
+import yaml
 
-		self.card_folder = path_reg_ex.group('path')
-		self.card_fn = fn_reg_ex.group('fn')
+# Card descriptions and decks, and the build profiler, also used on their own by the command line
+from MedRefProfile import MedRefProfiler, profiler, profiled
+from MedRefDeck import (yaml_loader, yaml_dump, file_hash, find_files, set_frame_layout, xtitle, list_frame_layouts,
+						MedRefCardFace, MedRefCard, MedRefCatalogue, MedRefDeck)
 
-		self.domain = card_dict['domain'].lower()
-		self.category = card_dict['category'].lower()
+# Placement of cards on printed sheets, for double-sided output
+from MedRefImposition import MedRefImposition
 
-		self.modified_date = card_dict['modified_date']
-		self.verified_date = card_dict['verified_date']
-		self.verified_by = card_dict['verified_by']
+# Full-text search index written next to each pdf
+from MedRefSearch import MedRefSearchIndex
 
-		self.front_face = MedRefCardFace(
-			card_dict['front_header'],
-			os.path.join(self.card_folder, self.card_fn + '-front.pdf'),
-			card_dict['front_footer'],
-			card_dict['front_toc'],
-			card_dict['front_references']
-		)
+# Images in card contents resampled to the resolution of a frame layout
+from MedRefImages import MedRefImageResampler
 
-		self.back_face = MedRefCardFace(
-			card_dict['back_header'],
-			os.path.join(self.card_folder, self.card_fn + '-back.pdf'),
-			card_dict['back_footer'],
-			card_dict['back_toc'],
-			card_dict['back_references']
-		)
+# Uses reportlab to generate the colour frame and the header/footer
+from reportlab.pdfgen import canvas
+from reportlab.lib.units import cm
 
-		def __repr__(self):
-			return repr((self.card_folder, self.card_fn, self.domain, self.category, self.modified_date, self.verified_date,
-				self.verified_by, self.front_face, self.back_face))
+# Uses pdfrw to include the contents of each card, saved as separate pdf:s
+from pdfrw import PdfReader, PdfDict, PdfArray, PdfName, PdfObject, PdfString
+from pdfrw.pdfwriter import user_fmt
+from pdfrw.buildxobj import pagexobj
+from pdfrw.toreportlab import makerl
 
+# Optionally uses pikepdf to write compact cross-reference and object streams in optimised mode
+try:
+	import pikepdf
+except ImportError:
+	pikepdf = None
+
+# Split output: one small pdf per card or per domain, with a manifest.json for clients that only fetch what they open
+SPLIT_MODES = ('card', 'domain')
+
+# Size of the folder of pre-rendered card faces, above which the faces used longest ago are removed
+FRAGMENT_FOLDER_SIZE = 256 * 1024 * 1024
+
+# Faces used this recently are kept, as another build sharing the folder may be about to read them
+FRAGMENT_MIN_AGE = 60
+
+# Modules whose code decides what goes into a pdf, so that changing any of them makes earlier outputs and fragments stale
+GENERATOR_MODULES = ('MedRefCards', 'MedRefDeck', 'MedRefFilter', 'MedRefImages', 'MedRefImposition', 'MedRefSearch')
+
+
+# Describe the sizes returned by write_object_streams
+def format_optimisation(optimisation):
+	description = '{:,} bytes with compressed streams'.format(optimisation['compressed_bytes'])
+	if optimisation['object_stream_bytes'] is not None:
+		description += ', {:,} bytes with object streams'.format(optimisation['object_stream_bytes'])
+	return description + ', {} objects ({:,} stream bytes) deduplicated so far'.format(optimisation['deduplicated_objects'], optimisation['deduplicated_bytes'])
+
+
+# Return one hash of the source of every generator module
+def generator_hash():
+	sha1 = hashlib.sha1()
+	for module_name in GENERATOR_MODULES:
+		module_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), module_name + '.py')
+		sha1.update((module_name + '=' + str(file_hash(module_path)) + ';').encode('utf-8'))
+	return sha1.hexdigest()
+
+# Rebuild a pdfrw dictionary from its pickled parts
+def _unpickle_pdf_dict(stream, attributes):
+	pdf_dict = PdfDict()
+	pdf_dict._stream = stream
+	vars(pdf_dict).update(attributes)
+	return pdf_dict
+
+
+class _ContentPickler(pickle.Pickler):
+	"""Pickler for fully resolved pdfrw objects"""
+	def reducer_override(self, obj):
+		# PdfDict answers every unknown attribute (like __setstate__) with None, so it is reduced by hand
+		if isinstance(obj, PdfDict):
+			attributes = dict((key, value) for key, value in vars(obj).items() if key not in ('stream', 'derived_rl_obj'))
+			return (_unpickle_pdf_dict, (obj.stream, attributes), None, None, iter(dict.items(obj)))
+		return NotImplemented
+
+
+# The dbm modules behind shelve are not safe to read while they are written, also not from threads of the same process
+_disk_cache_lock = threading.Lock()
+
+
+class MedRefContentCache():
+	"""Cache of imported card contents, keyed by path, modification time and size"""
+	def __init__(self, max_items=256, cache_file=None):
+		self.max_items = max_items
+		self.cache_file = cache_file
+		self.read_only = False
+		self.pages = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+		# Identical objects (fonts, images, ...) shared between imported contents, when deduplicating
+		self.deduplicate = False
+		self.canonical = {}
+		self.canonical_keys = {}
+		self.deduplicated_objects = 0
+		self.deduplicated_bytes = 0
+
+		# Upcoming contents being read and parsed by a thread pool, when prefetching
+		self.prefetch_executor = None
+		self.prefetch_queue = collections.deque()
+		self.prefetch_depth = 0
+		self.prefetched = {}
 
-class MedRefDeck():
-	"""Medical Reference Card Deck"""
+	def __repr__(self):
+		return repr((self.max_items, self.cache_file, list(self.pages.keys())))
+
+	def __getstate__(self):
+		# Imported pages stay with the process that parsed them
+		state = vars(self).copy()
+		state['pages'] = collections.OrderedDict()
+		state['canonical'] = {}
+		state['canonical_keys'] = {}
+		state['prefetch_executor'] = None
+		state['prefetch_queue'] = collections.deque()
+		state['prefetched'] = {}
+		return state
+
+	def get(self, content_path):
+		stat = os.stat(content_path)
+		signature = (stat.st_mtime_ns, stat.st_size)
+
+		# Memory tier
+		if content_path in self.pages:
+			cached_signature, page = self.pages[content_path]
+			if cached_signature == signature:
+				self.pages.move_to_end(content_path)
+				self.hits += 1
+				profiler.count('content_cache_hits')
+				return page
+
+		# Disk tier or parsed, possibly already by a prefetch thread
+		prefetched = self.prefetched.pop(content_path, None)
+		if prefetched is not None and prefetched[0] == signature:
+			with profiler.stage('content_prefetch_wait'):
+				page, parsed = prefetched[1].result()
+		else:
+			with profiler.stage('content_import'):
+				page, parsed = self.load(content_path, signature)
+		self.prefetch_more()
+
+		if parsed:
+			self.misses += 1
+			profiler.count('content_cache_misses')
+
+			if self.cache_file is not None and not self.read_only:
+				self.resolve(page)
+				pickled_page = self.dumps(page)
+				with _disk_cache_lock, shelve.open(self.cache_file) as disk_cache:
+					disk_cache[content_path] = (signature, pickled_page)
+		else:
+			self.hits += 1
+			profiler.count('content_cache_disk_hits')
+
+		if self.deduplicate:
+			self.deduplicate_objects(page)
+
+		self.pages[content_path] = (signature, page)
+		self.pages.move_to_end(content_path)
+		while len(self.pages) > self.max_items:
+			self.pages.popitem(last=False)
+
+		return page
+
+	def load(self, content_path, signature):
+		# Return the page from the disk tier, or parsed from the pdf, and whether it was parsed. Safe to run in a prefetch
+		# thread, as the disk tier is only opened under _disk_cache_lock.
+		if self.cache_file is not None:
+			entry = None
+			try:
+				with _disk_cache_lock, shelve.open(self.cache_file, 'r') as disk_cache:
+					entry = disk_cache.get(content_path)
+			except dbm.error:
+				pass
+			if entry is not None and entry[0] == signature:
+				return pickle.loads(entry[1]), False
+
+		return pagexobj(PdfReader(content_path).pages[0]), True
+
+	def prefetch(self, content_paths, depth=8, threads=4):
+		# Read and parse contents in the order they will be drawn, at most depth of them ahead of the drawing
+		self.stop_prefetching()
+		if self.prefetch_executor is None:
+			self.prefetch_executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='content-prefetch')
+		self.prefetch_queue = collections.deque(content_paths)
+		self.prefetch_depth = depth
+		self.prefetch_more()
+
+	def prefetch_more(self):
+		while len(self.prefetched) < self.prefetch_depth and len(self.prefetch_queue) > 0:
+			content_path = self.prefetch_queue.popleft()
+			if content_path in self.prefetched or not os.path.isfile(content_path):
+				continue
+
+			stat = os.stat(content_path)
+			signature = (stat.st_mtime_ns, stat.st_size)
+			if content_path in self.pages and self.pages[content_path][0] == signature:
+				continue
+
+			self.prefetched[content_path] = (signature, self.prefetch_executor.submit(self.load, content_path, signature))
+
+	def stop_prefetching(self):
+		for signature, future in self.prefetched.values():
+			future.cancel()
+		self.prefetched = {}
+		self.prefetch_queue = collections.deque()
+		self.prefetch_depth = 0
+
+	def start_deduplicating(self):
+		# Deduplicate the contents imported so far, and everything imported from now on, until stop_deduplicating
+		if not self.deduplicate:
+			self.deduplicate = True
+			for signature, page in self.pages.values():
+				self.deduplicate_objects(page)
+
+	def stop_deduplicating(self):
+		# Objects that were already replaced stay shared, contents imported from now on are left as they are
+		self.deduplicate = False
+		self.canonical = {}
+		self.canonical_keys = {}
+
+	def deduplicate_objects(self, pdf_obj, memo=None):
+		# Return a content key for a pdfrw object, built from the keys of its children, and
+		# replace every indirect child by the first imported object with the same key
+		if memo is None:
+			memo = {}
+
+		if not isinstance(pdf_obj, (PdfDict, PdfArray)):
+			return 'v' + str(getattr(pdf_obj, 'encoded', None) or pdf_obj)
+
+		if id(pdf_obj) in self.canonical_keys:
+			return self.canonical_keys[id(pdf_obj)]
+		if id(pdf_obj) in memo:
+			# Objects that are part of a cycle are left alone
+			return memo[id(pdf_obj)] or 'cycle-' + str(id(pdf_obj))
+		memo[id(pdf_obj)] = None
+
+		key = hashlib.sha1()
+		if isinstance(pdf_obj, PdfDict):
+			key.update(b'd')
+			for name, value in sorted(pdf_obj.iteritems()):
+				value_key = self.deduplicate_objects(value, memo)
+				key.update((name + '=' + value_key + ';').encode('utf-8'))
+				value = self.canonical_object(value, value_key)
+				if value is not None:
+					dict.__setitem__(pdf_obj, name, value)
+			if pdf_obj.stream is not None:
+				key.update(b's')
+				key.update(pdf_obj.stream.encode('latin-1'))
+		else:
+			key.update(b'a')
+			for index, value in enumerate(pdf_obj):
+				value_key = self.deduplicate_objects(value, memo)
+				key.update((value_key + ';').encode('utf-8'))
+				value = self.canonical_object(value, value_key)
+				if value is not None:
+					list.__setitem__(pdf_obj, index, value)
+
+		key = memo[id(pdf_obj)] = key.hexdigest()
+		return key
+
+	def canonical_object(self, pdf_obj, key):
+		# Return an identical object to use instead of pdf_obj, or None to keep it
+		if not isinstance(pdf_obj, (PdfDict, PdfArray)) or not pdf_obj.indirect or key.startswith('cycle-'):
+			return None
+
+		canonical = self.canonical.get(key)
+		if canonical is None:
+			self.canonical[key] = pdf_obj
+			self.canonical_keys[id(pdf_obj)] = key
+			return None
+		if canonical is pdf_obj:
+			return None
+
+		self.deduplicated_objects += 1
+		if isinstance(pdf_obj, PdfDict) and pdf_obj.stream is not None:
+			self.deduplicated_bytes += len(pdf_obj.stream)
+		return canonical
+
+	def release(self, c):
+		# Forget the reportlab objects created for a canvas, so that cached pages do not keep finished documents alive
+		seen = set()
+		for signature, page in self.pages.values():
+			# Only pages drawn on this canvas have been converted for its document
+			if c._doc in (vars(page).get('derived_rl_obj') or {}):
+				self.forget(page, c._doc, seen)
+
+	def forget(self, pdf_obj, rl_doc, seen):
+		if id(pdf_obj) in seen or not isinstance(pdf_obj, (PdfDict, PdfArray)):
+			return
+		seen.add(id(pdf_obj))
+
+		derived = vars(pdf_obj).get('derived_rl_obj')
+		if derived is not None:
+			derived.pop(rl_doc, None)
+
+		for value in (pdf_obj.values() if isinstance(pdf_obj, PdfDict) else pdf_obj):
+			self.forget(value, rl_doc, seen)
+
+	def resolve(self, pdf_obj, seen=None):
+		# Load every indirect object, and detach them from the reader, so that the page can be pickled
+		if seen is None:
+			seen = set()
+		if id(pdf_obj) in seen or not isinstance(pdf_obj, (PdfDict, PdfArray)):
+			return
+		seen.add(id(pdf_obj))
+
+		if pdf_obj.indirect:
+			pdf_obj.indirect = True
+
+		for value in (pdf_obj.values() if isinstance(pdf_obj, PdfDict) else pdf_obj):
+			self.resolve(value, seen)
+
+	def dumps(self, page):
+		buffer = io.BytesIO()
+		_ContentPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(page)
+		return buffer.getvalue()
 
-	def __init__(self, localisation, card_filter, content_path):
+class MedRefCards():
+	"""Class for generating and printing medical reference cards"""
+	def __init__(self, localisation='eng', card_filter='all', content_path='../contents', content_cache_size=256, content_cache_file=None,
+				 fragment_folder=None, catalogue_file=None, theme_path='../theme', prefetch_depth=0, image_cache_folder=None,
+				 fragment_folder_size=FRAGMENT_FOLDER_SIZE):
 		self.localisation = localisation
 		self.card_filter = card_filter
-		self.content_path = os.path.join(content_path, localisation)
-		self.cards = []
-		self.domain_index = []
-
-		card_files = self.find_all_cards()
+		self.content_path = content_path
+		self.theme_path = theme_path
+		self.theme_files = {}
 
-		# Create a list of all MedRefCards
-		active_domain = ''
-		for card_file in card_files:
-			self.cards.append(MedRefCard(card_file))
-			if self.cards[-1].domain != active_domain:
-				self.domain_index.append(self.cards[-1].domain)
-				active_domain = self.cards[-1].domain
+		# The catalogue is kept, so that reloading the deck only parses changed cards
+		self.catalogue = MedRefCatalogue(catalogue_file)
+		self.reload_deck()
 
-		logging.info('Deck generated successfully. Number of cards: ' + str(len(self.cards)))
+		# Imported card contents are shared by all generated pdf:s
+		self.content_cache = MedRefContentCache(content_cache_size, content_cache_file)
 
-	def __repr__(self):
-		return repr((self.localisation, self.card_filter, self.content_path, self.cards))
+		# Number of upcoming card contents read and parsed in the background while drawing
+		self.prefetch_depth = prefetch_depth
 
-	def find_all_cards(self):
-		pattern = '*.yml'
-		path = self.content_path
-		result = []
-		for root, dirs, files in os.walk(path):
-			for name in files:
-				if fnmatch.fnmatch(name, pattern):
-					result.append(os.path.join(root, name))
-		return result
+		# Card contents with their images resampled, for frame layouts with an images section
+		self.image_resampler = MedRefImageResampler(image_cache_folder)
 
-	def sort(self, reverse=False):
-		self.cards = sorted(self.cards, key=lambda card: card.domain, reverse=reverse)
+		# Pages each card face is drawn on, for the search index of the pdf being generated
+		self.face_pages = {}
+		self.page_offset = 0
 
+		self.optimisation = None
 
-class MedRefCards():
-	"""Class for generating and printing medical reference cards"""
-	def __init__(self, localisation='eng', card_filter='all', content_path='../contents'):
-		self.med_ref_deck = self.generate_deck(localisation, card_filter, content_path)
-		self.sort_deck()
+		# Pre-rendered card faces, reused by every deck that includes them
+		self.fragment_folder = fragment_folder
+		if fragment_folder is not None and not os.path.isdir(fragment_folder):
+			os.makedirs(fragment_folder)
+		self.fragment_folder_size = fragment_folder_size
+		self.fragments_drawn = 0
 
 	def __repr__(self):
 		return repr((self.med_ref_deck))
 
-	def generate_deck(self, localisation='eng', card_filter='all', content_path='../contents'):
-		return MedRefDeck(localisation, card_filter, content_path)
+	def generate_deck(self, localisation='eng', card_filter='all', content_path='../contents', catalogue=None):
+		return MedRefDeck(localisation, card_filter, content_path, catalogue)
+
+	def reload_deck(self):
+		with profiler.stage('deck'):
+			self.med_ref_deck = self.generate_deck(self.localisation, self.card_filter, self.content_path, self.catalogue)
+		with profiler.stage('sort'):
+			self.sort_deck()
+
+	def load_theme_file(self, theme_file):
+		# Parsed colour schemes and frame layouts are kept until the file changes
+		stat = os.stat(theme_file)
+		signature = (stat.st_mtime_ns, stat.st_size)
+		if theme_file not in self.theme_files or self.theme_files[theme_file][0] != signature:
+			self.theme_files[theme_file] = (signature, yaml_loader(theme_file))
+		return self.theme_files[theme_file][1]
 
 	def sort_deck(self, reverse=False):
 		self.med_ref_deck.sort(reverse)
@@ -163,22 +422,28 @@ class MedRefCards():
 					 output_folder='../pdf', file_name=None,
 					 domain_filter=None, df_invert=False,
 					 category_filter=None, cf_invert=False,
-					 no_title=False):
+					 no_title=False, force=False, optimise=False, card_ids=None, stream_pages=None, split=None, no_manifest=False):
+		# Without a manifest, a pdf is always drawn, and written without its build manifest and search index, e.g. for one-off pdf:s
+		start_time = time.perf_counter()
+
+		# Sizes of the last optimised build, for reporting
+		self.optimisation = None
+
 		## Colour scheme check
-		colour_scheme_path = os.path.join('../theme/colour-schemes', colour_scheme + '.yml')
+		colour_scheme_path = os.path.join(self.theme_path, 'colour-schemes', colour_scheme + '.yml')
 		if not os.path.isfile(colour_scheme_path):
 			logging.warning('No colour scheme: ' + colour_scheme + '. Using colour scheme: default.')
-			colour_scheme_path = '../theme/colour-schemes/default-colour-scheme.yml'
+			colour_scheme_path = os.path.join(self.theme_path, 'colour-schemes', 'default-colour-scheme.yml')
 
 		## Frame layout check
-		frame_layout_path = os.path.join('../theme/frame-layouts', frame_layout + '.yml')
+		frame_layout_path = os.path.join(self.theme_path, 'frame-layouts', frame_layout + '.yml')
 		if not os.path.isfile(frame_layout_path):
 			logging.warning('No frame layout: ' + frame_layout + '. Using frame layout: default.')
-			frame_layout_path = '../theme/frame-layouts/default-frame-layout.yml'
+			frame_layout_path = os.path.join(self.theme_path, 'frame-layouts', 'default-frame-layout.yml')
 
-		colour_scheme = yaml_loader(colour_scheme_path)
+		colour_scheme = self.load_theme_file(colour_scheme_path)
 		frame_layout_name = frame_layout
-		frame_layout = self.set_frame_layout(yaml_loader(frame_layout_path))
+		frame_layout = self.set_frame_layout(self.load_theme_file(frame_layout_path))
 
 		if file_name is not None:
 			output_fn = file_name + '.pdf'
@@ -187,66 +452,417 @@ class MedRefCards():
 
 		output_path = os.path.join(output_folder, self.med_ref_deck.localisation, output_fn)
 
+		cards = self.select_cards(domain_filter, df_invert, category_filter, cf_invert, card_ids)
+
+		## Split output, in a folder named like the pdf would be
+		if split is not None:
+			output_path = os.path.join(output_folder, self.med_ref_deck.localisation, file_name if file_name is not None else frame_layout_name)
+			manifest_path = self.generate_split_pdfs(output_path, cards, split, colour_scheme, colour_scheme_path, frame_layout, frame_layout_path, force, optimise)
+			self.prune_fragments()
+			if profiler.enabled:
+				profiler.add_output(manifest_path, time.perf_counter() - start_time)
+			return manifest_path
+
+		## Build manifest check
+		build_args = {
+			'domain_filter': None if domain_filter is None else list(domain_filter), 'df_invert': df_invert,
+			'category_filter': None if category_filter is None else list(category_filter), 'cf_invert': cf_invert,
+			'no_title': no_title, 'optimise': optimise,
+			'card_ids': None if card_ids is None else list(card_ids)
+		}
+		manifest_path = os.path.splitext(output_path)[0] + '.manifest.yml'
+		index_path = os.path.splitext(output_path)[0] + '.index.json'
+		manifest = None if no_manifest else self.build_manifest(cards, colour_scheme_path, frame_layout_path, build_args)
+
+		if not force and manifest is not None and os.path.isfile(output_path) and os.path.isfile(manifest_path) and os.path.isfile(index_path):
+			changes = self.manifest_changes(yaml_loader(manifest_path), manifest)
+			if len(changes) == 0:
+				logging.info('Up to date: ' + output_path)
+				return output_path
+			logging.info('Rebuilding ' + output_path + ': ' + ', '.join(changes))
 
 		if frame_layout['output'] == 'spread':
 			canvas_size = (frame_layout['card_spread']['width']*cm, frame_layout['card_spread']['height']*cm)
 			draw_card = self.draw_card_spread
 		elif frame_layout['output'] == 'double-sided':
-			draw_size = canvas_size = (2*frame_layout['card']['width']*cm, 2*frame_layout['card']['height']*cm)
+			draw_size = canvas_size = self.compile_theme(colour_scheme, frame_layout).imposition.sheet_size()
 			draw_card = self.draw_double_sided
 		else:
 			draw_size = canvas_size = (frame_layout['card']['width']*cm, frame_layout['card']['height']*cm)
 			draw_card = self.draw_card_page
 
-		c = canvas.Canvas(output_path, canvas_size, pageCompression = 0)
+		# Optimised mode compresses streams and writes identical imported objects only once
+		page_compression = 1 if optimise else 0
+		if optimise:
+			self.content_cache.start_deduplicating()
 
-		if not no_title:
-			self.draw_title_page(c, canvas_size[0], canvas_size[1])
+		self.face_pages = {}
+		self.page_offset = 0
 
-		active_domain = ''
-		domain_index = []
+		# Pre-rendered faces do not need their contents, so only direct drawing prefetches them
+		if self.prefetch_depth > 0 and self.fragment_folder is None:
+			self.content_cache.prefetch(self.content_order(cards, colour_scheme, frame_layout), self.prefetch_depth)
+
+		try:
+			if stream_pages is not None:
+				self.stream_pdf(output_path, canvas_size, cards, colour_scheme, frame_layout, draw_card, no_title, page_compression, stream_pages)
+			else:
+				c = canvas.Canvas(output_path, canvas_size, pageCompression = page_compression)
 
+				if not no_title:
+					self.draw_title_page(c, canvas_size[0], canvas_size[1])
+				else:
+					self.add_outline_root(c)
+
+				self.draw_cards(c, cards, colour_scheme, frame_layout, draw_card)
+
+				with profiler.stage('save'):
+					c.save()
+				self.content_cache.release(c)
+		finally:
+			self.content_cache.stop_prefetching()
+			if optimise:
+				self.content_cache.stop_deduplicating()
+
+		if optimise:
+			self.optimisation = self.write_object_streams(output_path)
+		if manifest is not None:
+			self.write_search_index(index_path, output_fn, cards)
+			yaml_dump(manifest_path, manifest)
+		self.prune_fragments()
+
+		if profiler.enabled:
+			profiler.add_output(output_path, time.perf_counter() - start_time)
+
+		logging.info('Content cache hits: ' + str(self.content_cache.hits) + ', misses: ' + str(self.content_cache.misses))
+
+		return output_path
+
+	def draw_cards(self, c, cards, colour_scheme, frame_layout, draw_card, active_domain=''):
+		# Draw the cards in order, adding a domain entry to the outline where a new domain starts
 		if frame_layout['output'] == 'double-sided':
-			cards_for_page = []
-			for card in self.med_ref_deck.cards:
-				if 	category_filter is None or not cf_invert and card.category.lower() in category_filter or cf_invert and card.category.lower() not in category_filter:
-					if 	domain_filter is None or not df_invert and card.domain.lower() in domain_filter or df_invert and card.domain.lower() not in domain_filter:
-						cards_for_page.append(card)
-						if len(cards_for_page) == 4:
-							draw_card(c, cards_for_page, colour_scheme, frame_layout)
-							cards_for_page = []
-			if len(cards_for_page) > 0:
-				draw_card(c, cards_for_page, colour_scheme, frame_layout)
+			cards_per_sheet = self.compile_theme(colour_scheme, frame_layout).imposition.cards_per_sheet
+			for card_nr in range(0, len(cards), cards_per_sheet):
+				draw_card(c, cards[card_nr:card_nr+cards_per_sheet], colour_scheme, frame_layout)
+			return active_domain
+
+		for card in cards:
+			if card.domain != active_domain:
+				self.add_toc_item(c, xtitle(card.domain), 'domain-' + card.domain, 1, True)
+				active_domain = card.domain
+			draw_card(c, card, colour_scheme, frame_layout)
 
+		return active_domain
+
+	def content_order(self, cards, colour_scheme, frame_layout):
+		# The content pdf:s in the order draw_cards uses them
+		if frame_layout['output'] == 'double-sided':
+			imposition = self.compile_theme(colour_scheme, frame_layout).imposition
+			content_paths = []
+			for card_nr in range(0, len(cards), imposition.cards_per_sheet):
+				cards_for_sheet = cards[card_nr:card_nr+imposition.cards_per_sheet]
+				if imposition.spreads:
+					content_paths.extend(self.face_content_path(card_face, frame_layout) for card in cards_for_sheet for card_face in (card.front_face, card.back_face))
+				else:
+					content_paths.extend(self.face_content_path(card.front_face, frame_layout) for card in cards_for_sheet[::-1])
+					content_paths.extend(self.face_content_path(card.back_face, frame_layout) for card in cards_for_sheet[::-1])
+			return content_paths
+
+		return [self.face_content_path(card_face, frame_layout) for card in cards for card_face in (card.front_face, card.back_face)]
+
+	def face_content_path(self, card_face, frame_layout):
+		# The content pdf of a face, with its images resampled when the frame layout sets a resolution
+		if (frame_layout.get('images') or {}).get('dpi') is None or not os.path.isfile(card_face.content_path):
+			return card_face.content_path
+
+		with profiler.stage('image_resample'):
+			return self.image_resampler.content_path(card_face.content_path, file_hash(card_face.content_path), frame_layout['images'])
+
+	def stream_pdf(self, output_path, canvas_size, cards, colour_scheme, frame_layout, draw_card, no_title, page_compression, stream_pages):
+		# Render chunks of about stream_pages pages to a temporary pdf each, and append them to the output one at a time,
+		# so that neither the canvas nor the merge ever holds more than one chunk
+		if frame_layout['output'] == 'double-sided':
+			imposition = self.compile_theme(colour_scheme, frame_layout).imposition
+			pages_per_draw, cards_per_draw = imposition.pages_per_sheet, imposition.cards_per_sheet
 		else:
-			for card in self.med_ref_deck.cards:
-				if 	category_filter is None or not cf_invert and card.category.lower() in category_filter or cf_invert and card.category.lower() not in category_filter:
-					if 	domain_filter is None or not df_invert and card.domain.lower() in domain_filter or df_invert and card.domain.lower() not in domain_filter:
-						if card.domain != active_domain:
-							self.add_toc_item(c, xtitle(card.domain), 'domain-' + card.domain, 1, True)
-							domain_index.append(card.domain)
-							active_domain = card.domain
-						draw_card(c, card, colour_scheme, frame_layout)
+			pages_per_draw, cards_per_draw = {'spread': (1, 1)}.get(frame_layout['output'], (2, 1))
+		cards_per_chunk = max(1, stream_pages // pages_per_draw) * cards_per_draw
 
-		c.save()
+		chunk_path = os.path.splitext(output_path)[0] + '.chunk-' + str(os.getpid()) + '.pdf'
+		writer = MedRefPdfStreamWriter(output_path)
+		card_iterator = iter(cards)
+		active_domain = ''
 
-	def set_frame_layout(self, frame_layout):
-		frame_layout['card'] = {
-			'width': frame_layout['border']['left'] + frame_layout['content']['width'] + frame_layout['border']['right'],
-			'height': frame_layout['border']['top'] + frame_layout['content']['height'] + frame_layout['border']['bottom']
+		try:
+			chunk = list(itertools.islice(card_iterator, cards_per_chunk))
+			draw_title = not no_title
+			while len(chunk) > 0 or draw_title:
+				c = canvas.Canvas(chunk_path, canvas_size, pageCompression = page_compression)
+				c.toc_items = []
+				self.page_offset = len(writer.page_refs)
+
+				if draw_title:
+					self.draw_title_page(c, canvas_size[0], canvas_size[1])
+					draw_title = False
+				elif no_title and len(writer.page_refs) == 0:
+					self.add_outline_root(c)
+
+				active_domain = self.draw_cards(c, chunk, colour_scheme, frame_layout, draw_card, active_domain)
+
+				with profiler.stage('save'):
+					c.save()
+				self.content_cache.release(c)
+
+				with profiler.stage('merge'):
+					writer.add_pages(chunk_path, c.toc_items)
+
+				chunk = list(itertools.islice(card_iterator, cards_per_chunk))
+
+			with profiler.stage('merge'):
+				writer.close()
+		finally:
+			writer.file.close()
+			if os.path.isfile(chunk_path):
+				os.remove(chunk_path)
+
+	def generate_split_pdfs(self, output_path, cards, split, colour_scheme, colour_scheme_path, frame_layout, frame_layout_path, force=False, optimise=False):
+		# Write one pdf per card or domain to output_path, and a manifest.json with what each pdf holds, its size and content hash.
+		# Only pdf:s whose inputs changed are drawn again, and the output is byte for byte the same for the same inputs,
+		# so clients download a card again only when its hash has changed
+		if split not in SPLIT_MODES:
+			raise ValueError('Unknown split: ' + str(split) + ', use one of: ' + ', '.join(SPLIT_MODES))
+
+		os.makedirs(output_path, exist_ok=True)
+		manifest_path = os.path.join(output_path, 'manifest.json')
+
+		old_files = {}
+		if not force and os.path.isfile(manifest_path):
+			try:
+				with open(manifest_path, 'r') as file_descriptor:
+					old_manifest = json.load(file_descriptor)
+				if old_manifest.get('version') == 1:
+					old_files = dict((entry['file'], entry) for entry in old_manifest['files'])
+			except ValueError:
+				logging.warning('Unreadable split manifest: ' + manifest_path + '. Drawing every pdf again.')
+
+		units = collections.OrderedDict()
+		for card in cards:
+			unit_name = card.card_fn if split == 'card' else re.sub(r'[^\w-]+', '-', card.domain.lower())
+			units.setdefault(unit_name + '.pdf', []).append(card)
+
+		draw_card = {'spread': self.draw_card_spread, 'double-sided': self.draw_double_sided}.get(frame_layout['output'], self.draw_card_page)
+		if frame_layout['output'] == 'spread':
+			canvas_size = (frame_layout['card_spread']['width']*cm, frame_layout['card_spread']['height']*cm)
+		elif frame_layout['output'] == 'double-sided':
+			canvas_size = self.compile_theme(colour_scheme, frame_layout).imposition.sheet_size()
+		else:
+			canvas_size = (frame_layout['card']['width']*cm, frame_layout['card']['height']*cm)
+
+		files = []
+		stale = []
+		build_args = {'split': split, 'optimise': optimise}
+		for unit_file, unit_cards in units.items():
+			unit_manifest = self.build_manifest(unit_cards, colour_scheme_path, frame_layout_path, build_args)
+			inputs = hashlib.sha1(json.dumps(unit_manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+			old_entry = old_files.get(unit_file)
+			unit_path = os.path.join(output_path, unit_file)
+			if old_entry is not None and old_entry['inputs'] == inputs and os.path.isfile(unit_path) and os.path.getsize(unit_path) == old_entry['size']:
+				files.append(old_entry)
+			else:
+				files.append({'file': unit_file, 'inputs': inputs})
+				stale.append((files[-1], unit_cards))
+
+		if self.prefetch_depth > 0 and self.fragment_folder is None:
+			self.content_cache.prefetch(self.content_order([card for entry, unit_cards in stale for card in unit_cards], colour_scheme, frame_layout), self.prefetch_depth)
+
+		page_compression = 1 if optimise else 0
+		try:
+			for entry, unit_cards in stale:
+				unit_path = os.path.join(output_path, entry['file'])
+				temp_path = unit_path + '.' + str(os.getpid()) + '.tmp'
+
+				# Invariant canvases leave out the creation date and random id, so that unchanged cards keep their hash
+				c = canvas.Canvas(temp_path, canvas_size, pageCompression = page_compression, invariant = 1)
+				self.face_pages = {}
+				self.page_offset = 0
+
+				# Without a title page, the outline starts at the card or domain
+				if split == 'card':
+					self.add_toc_item(c, unit_cards[0].front_face.header + ' / ' + unit_cards[0].back_face.header, 'split', 0)
+				else:
+					self.add_toc_item(c, xtitle(unit_cards[0].domain), 'split', 0)
+				self.draw_cards(c, unit_cards, colour_scheme, frame_layout, draw_card)
+
+				with profiler.stage('save'):
+					c.save()
+				self.content_cache.release(c)
+				self.linearise(temp_path, unit_path)
+
+				entry['size'] = os.path.getsize(unit_path)
+				entry['sha1'] = file_hash(unit_path)
+				entry['cards'] = [{
+					'id': card.card_fn,
+					'domain': card.domain,
+					'category': card.category,
+					'front_header': card.front_face.header,
+					'back_header': card.back_face.header,
+					'front_toc': [title for title in card.front_face.toc if title != ''],
+					'back_toc': [title for title in card.back_face.toc if title != ''],
+					'front_pages': sorted(self.face_pages.get(id(card.front_face), [])),
+					'back_pages': sorted(self.face_pages.get(id(card.back_face), []))
+				} for card in unit_cards]
+		finally:
+			self.content_cache.stop_prefetching()
+
+		# Pdf:s of cards or domains that are no longer in the output
+		for unit_file in old_files:
+			if unit_file not in units and os.path.isfile(os.path.join(output_path, unit_file)):
+				os.remove(os.path.join(output_path, unit_file))
+
+		manifest = {
+			'version': 1,
+			'localisation': self.med_ref_deck.localisation,
+			'split': split,
+			'size': sum(entry['size'] for entry in files),
+			'files': files
+		}
+		temp_path = manifest_path + '.' + str(os.getpid()) + '.tmp'
+		with open(temp_path, 'w') as file_descriptor:
+			json.dump(manifest, file_descriptor, indent=1, sort_keys=True, ensure_ascii=False)
+		os.replace(temp_path, manifest_path)
+
+		logging.info('Split ' + output_path + ': ' + str(len(stale)) + ' of ' + str(len(files)) + ' pdf:s drawn, ' + str(manifest['size']) + ' bytes in total')
+		return manifest_path
+
+	def linearise(self, temp_path, output_path):
+		# Linearised pdf:s show their first page before the whole file has downloaded
+		if pikepdf is None:
+			os.replace(temp_path, output_path)
+			return
+
+		with profiler.stage('linearise'):
+			with pikepdf.open(temp_path) as pdf:
+				pdf.save(output_path, linearize=True, deterministic_id=True)
+			os.remove(temp_path)
+
+	@profiled
+	def write_search_index(self, index_path, pdf_name, cards):
+		MedRefSearchIndex.build(pdf_name, cards, self.face_pages).save(index_path)
+
+	def select_cards(self, domain_filter=None, df_invert=False, category_filter=None, cf_invert=False, card_ids=None):
+		card_index = self.med_ref_deck.card_index
+
+		# Hand-picked cards, by file name, keep the order of the deck
+		if card_ids is not None:
+			selected = set(self.med_ref_deck.card_positions[card_id] for card_id in card_ids if card_id in self.med_ref_deck.card_positions)
+		else:
+			selected = card_index.all()
+
+		for field, field_filter, invert in (('category', category_filter, cf_invert), ('domain', domain_filter, df_invert)):
+			if field_filter is not None:
+				matching = card_index.lookup(field, '=', [value.lower() for value in field_filter])
+				if invert:
+					selected -= matching
+				else:
+					selected &= matching
+
+		return [self.med_ref_deck.cards[card_nr] for card_nr in sorted(selected)]
+
+	def build_manifest(self, cards, colour_scheme_path, frame_layout_path, build_args):
+		# Content hashes of everything that goes into a pdf
+		manifest = {
+			'generator': generator_hash(),
+			'colour_scheme': file_hash(colour_scheme_path),
+			'frame_layout': file_hash(frame_layout_path),
+			'build_args': build_args,
+			'domain_index': list(self.med_ref_deck.domain_index),
+			'card_order': [card.card_fn for card in cards],
+			'cards': {}
 		}
 
-		frame_layout['card_spread'] = {
-			'width': 2 * frame_layout['card']['width'],
-			'height': frame_layout['card']['height']
+		for card in cards:
+			manifest['cards'][card.card_fn] = {
+				'yml': file_hash(card.card_file),
+				'front': file_hash(card.front_face.content_path),
+				'back': file_hash(card.back_face.content_path)
+			}
+
+		return manifest
+
+	def manifest_changes(self, old_manifest, new_manifest):
+		# Describe what differs between two build manifests, card by card
+		changes = []
+		for key in ('generator', 'colour_scheme', 'frame_layout', 'build_args', 'domain_index'):
+			if old_manifest.get(key) != new_manifest[key]:
+				changes.append(key.replace('_', ' ') + ' changed')
+
+		old_cards = old_manifest.get('cards', {})
+		new_cards = new_manifest['cards']
+		for card_fn in new_manifest['card_order']:
+			if card_fn not in old_cards:
+				changes.append(card_fn + ' added')
+			elif old_cards[card_fn] != new_cards[card_fn]:
+				changed_files = [key for key in ('yml', 'front', 'back') if old_cards[card_fn].get(key) != new_cards[card_fn][key]]
+				changes.append(card_fn + ' changed (' + ', '.join(changed_files) + ')')
+		for card_fn in old_manifest.get('card_order', []):
+			if card_fn not in new_cards:
+				changes.append(card_fn + ' removed')
+
+		if len(changes) == 0 and old_manifest.get('card_order') != new_manifest['card_order']:
+			changes.append('card order changed')
+
+		return changes
+
+	@profiled
+	def write_object_streams(self, output_path):
+		# Return the sizes of the optimised pdf, as written by reportlab with compressed streams and shared objects, and with object streams
+		optimisation = {
+			'compressed_bytes': os.path.getsize(output_path),
+			'object_stream_bytes': None,
+			'deduplicated_objects': self.content_cache.deduplicated_objects,
+			'deduplicated_bytes': self.content_cache.deduplicated_bytes
 		}
 
-		return frame_layout
+		if pikepdf is None:
+			logging.info('Optimised ' + output_path + ' without object streams. Install pikepdf for object streams.')
+			return optimisation
+
+		with pikepdf.open(output_path, allow_overwriting_input=True) as pdf:
+			pdf.save(output_path, compress_streams=True, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+		optimisation['object_stream_bytes'] = os.path.getsize(output_path)
+
+		logging.info('Optimised ' + output_path + ': ' + format_optimisation(optimisation))
+		return optimisation
+
+	def warm_content_cache(self):
+		# Import the contents of every card once, filling the on-disk content cache. A content that
+		# cannot be read is left out, so that only the builds that draw it fail.
+		for card in self.med_ref_deck.cards:
+			for card_face in (card.front_face, card.back_face):
+				if os.path.isfile(card_face.content_path):
+					try:
+						self.content_cache.get(card_face.content_path)
+					except Exception as error:
+						logging.warning('Unreadable card content: ' + card_face.content_path + ': ' + str(error))
+
+	def set_frame_layout(self, frame_layout):
+		return set_frame_layout(frame_layout)
+
+	def add_outline_root(self, c):
+		# Without a title page, the domains still need an entry to be nested under
+		self.add_toc_item(c, 'Medical Reference Cards', 'title-page', 0)
 
 	def add_toc_item(self, c, title, key, level=0, closed=None):
+		# Streamed chunks only record their outline, which is rebuilt when the chunks are merged
+		if hasattr(c, 'toc_items'):
+			c.toc_items.append((title, level, closed, c.getPageNumber() - 1))
+			return
+
 		c.bookmarkPage(key)
 		c.addOutlineEntry(title, key, level, closed)
 
+	@profiled
 	def draw_title_page(self, c, width, height):
 		title_text = 'Medical Reference Cards'
 		subtitle_text = 'github.com/alping/medical-reference-cards'
@@ -265,9 +881,10 @@ class MedRefCards():
 
 		c.showPage()
 
+	@profiled
 	def draw_card_spread(self, c, card, colour_scheme, frame_layout):
-		self.draw_card_face(c, card.front_face, card.domain, colour_scheme, frame_layout, 1)
-		self.draw_card_face(c, card.back_face, card.domain, colour_scheme, frame_layout, 2, frame_layout['card']['width']*cm)
+		self.place_card_face(c, card.front_face, card.domain, colour_scheme, frame_layout, 1)
+		self.place_card_face(c, card.back_face, card.domain, colour_scheme, frame_layout, 2, frame_layout['card']['width']*cm)
 		self.add_toc_item(c, card.front_face.header + ' / ' + card.back_face.header, card.front_face.header + '-' + card.back_face.header, 2, True)
 
 		item_nr = 0
@@ -286,68 +903,40 @@ class MedRefCards():
 
 		c.showPage()
 
-	def draw_double_sided(self, c, cards_for_page, colour_scheme, frame_layout):
-		guide_width = 0.01*cm
-
-		for add in range(len(cards_for_page)+1, 5):
-			cards_for_page.append(None)
-
-		for card_number in range(4,0,-1):
-			if card_number % 2 == 0:
-				x_offset = frame_layout['card']['width']*cm
-			else:
-				x_offset = 0
-
-			if card_number > 2:
-				y_offset = 0
-			else:
-				y_offset = frame_layout['card']['height']*cm
-
-			if cards_for_page[card_number-1] is not None:
-				self.draw_card_face(c, cards_for_page[card_number-1].front_face, cards_for_page[card_number-1].domain, colour_scheme, frame_layout, 1, x_offset, y_offset)
-
-		c.setFillColorRGB(1, 1, 1)
-
-		c.rect(	frame_layout['card']['width']*cm - guide_width/2, 0,
-				guide_width, 2 * frame_layout['card']['height']*cm,
-				stroke=0, fill=1)
-
-		c.rect(	0, frame_layout['card']['height']*cm - guide_width/2,
-				2 * frame_layout['card']['width']*cm, guide_width,
-				stroke=0, fill=1)
-
-		c.showPage()
-
-		for card_number in range(4,0,-1):
-			if card_number % 2 == 0:
-				x_offset = 0
-			else:
-				x_offset = frame_layout['card']['width']*cm
-
-			if card_number > 2:
-				y_offset = 0
-			else:
-				y_offset = frame_layout['card']['height']*cm
-
-			if cards_for_page[card_number-1] is not None:
-				self.draw_card_face(c, cards_for_page[card_number-1].back_face, cards_for_page[card_number-1].domain, colour_scheme, frame_layout, 2, x_offset, y_offset)
-
-		c.setFillColorRGB(1, 1, 1)
-
-		c.rect(	frame_layout['card']['width']*cm - guide_width/2, 0,
-				guide_width, 2 * frame_layout['card']['height']*cm,
-				stroke=0, fill=1)
-
-		c.rect(	0, frame_layout['card']['height']*cm - guide_width/2,
-				2 * frame_layout['card']['width']*cm, guide_width,
-				stroke=0, fill=1)
-
-		c.showPage()
-
+	@profiled
+	def draw_double_sided(self, c, cards_for_sheet, colour_scheme, frame_layout):
+		imposition = self.compile_theme(colour_scheme, frame_layout).imposition
+
+		if imposition.spreads:
+			for card, (x_offset, y_offset) in zip(cards_for_sheet, imposition.positions(1)):
+				self.place_card_face(c, card.front_face, card.domain, colour_scheme, frame_layout, 1, x_offset, y_offset)
+				self.place_card_face(c, card.back_face, card.domain, colour_scheme, frame_layout, 2, x_offset + imposition.card_width, y_offset)
+			imposition.draw_marks(c, 1)
+			c.showPage()
+			return
+
+		# Fronts on one side of the sheet, and each back behind its front on the other
+		for face_nr in (1, 2):
+			for card, (x_offset, y_offset) in reversed(list(zip(cards_for_sheet, imposition.positions(face_nr)))):
+				if face_nr == 1:
+					self.place_card_face(c, card.front_face, card.domain, colour_scheme, frame_layout, 1, x_offset, y_offset)
+				elif imposition.rotate_backs:
+					# Half a turn about the centre of the cell
+					c.saveState()
+					c.translate(x_offset + imposition.card_width, y_offset + imposition.card_height)
+					c.rotate(180)
+					self.place_card_face(c, card.back_face, card.domain, colour_scheme, frame_layout, 2)
+					c.restoreState()
+				else:
+					self.place_card_face(c, card.back_face, card.domain, colour_scheme, frame_layout, 2, x_offset, y_offset)
+			imposition.draw_marks(c, face_nr)
+			c.showPage()
+
+	@profiled
 	def draw_card_page(self, c, card, colour_scheme, frame_layout):
 		self.add_toc_item(c, card.front_face.header + ' / ' + card.back_face.header, card.front_face.header + '-' + card.back_face.header, 2, True)
 
-		self.draw_card_face(c, card.front_face, card.domain, colour_scheme, frame_layout, 1)
+		self.place_card_face(c, card.front_face, card.domain, colour_scheme, frame_layout, 1)
 		self.add_toc_item(c, card.front_face.header, card.front_face.header, 3)
 
 		item_nr = 0
@@ -359,7 +948,7 @@ class MedRefCards():
 
 		c.showPage()
 
-		self.draw_card_face(c, card.back_face, card.domain, colour_scheme, frame_layout, 2)
+		self.place_card_face(c, card.back_face, card.domain, colour_scheme, frame_layout, 2)
 		self.add_toc_item(c, card.back_face.header, card.back_face.header, 3)
 
 		item_nr = 0
@@ -371,100 +960,398 @@ class MedRefCards():
 
 		c.showPage()
 
+	def place_card_face(self, c, card_face, domain, colour_scheme, frame_layout, face_nr, x_offset = 0, y_offset = 0):
+		self.face_pages.setdefault(id(card_face), set()).add(self.page_offset + c.getPageNumber())
+
+		if self.fragment_folder is None:
+			self.draw_card_face(c, card_face, domain, colour_scheme, frame_layout, face_nr, x_offset, y_offset)
+			return
+
+		fragment_path = self.card_face_fragment(card_face, domain, colour_scheme, frame_layout, face_nr, x_offset, y_offset)
+		page = self.content_cache.get(fragment_path)
+		c.saveState()
+		c.translate(x_offset, y_offset)
+		c.doForm(makerl(c, page))
+		c.restoreState()
+
+	@profiled
+	def card_face_fragment(self, card_face, domain, colour_scheme, frame_layout, face_nr, x_offset = 0, y_offset = 0):
+		# Everything that draw_card_face depends on goes into the fragment name
+		fragment_key = hashlib.sha1()
+		for part in (generator_hash(), yaml.dump(frame_layout), face_nr,
+					 domain, colour_scheme.get(domain), self.med_ref_deck.domain_index.index(domain), len(self.med_ref_deck.domain_index),
+					 card_face.header, file_hash(card_face.content_path)):
+			fragment_key.update(repr(part).encode('utf-8'))
+
+		fragment_path = os.path.join(self.fragment_folder, fragment_key.hexdigest() + '.pdf')
+		try:
+			# The access time is when the face was last used, for pruning the folder. The modification
+			# time is kept, as it is part of the signature the content cache knows the face by.
+			stat = os.stat(fragment_path)
+			os.utime(fragment_path, ns=(time.time_ns(), stat.st_mtime_ns))
+			return fragment_path
+		except FileNotFoundError:
+			pass
+
+		# Draw the face at its usual offset, moved back onto a card sized page
+		temp_path = fragment_path + '.' + str(os.getpid()) + '.tmp'
+		c = canvas.Canvas(temp_path, (frame_layout['card']['width']*cm, frame_layout['card']['height']*cm), pageCompression = 0)
+		c.translate(-x_offset, -y_offset)
+		self.draw_card_face(c, card_face, domain, colour_scheme, frame_layout, face_nr, x_offset, y_offset)
+		c.showPage()
+		c.save()
+		self.content_cache.release(c)
+		os.replace(temp_path, fragment_path)
+		self.fragments_drawn += 1
+
+		return fragment_path
+
+	def prune_fragments(self):
+		# Remove the faces used longest ago while the folder is larger than fragment_folder_size, after builds that added faces
+		if self.fragment_folder is None or self.fragments_drawn == 0:
+			return
+		self.fragments_drawn = 0
+
+		fragments = []
+		for name in os.listdir(self.fragment_folder):
+			try:
+				stat = os.stat(os.path.join(self.fragment_folder, name))
+			except FileNotFoundError:
+				continue
+			fragments.append((stat.st_atime, stat.st_size, name))
+
+		folder_size = sum(size for atime, size, name in fragments)
+		for atime, size, name in sorted(fragments):
+			if folder_size <= self.fragment_folder_size or atime > time.time() - FRAGMENT_MIN_AGE:
+				break
+			try:
+				os.remove(os.path.join(self.fragment_folder, name))
+			except FileNotFoundError:
+				pass
+			folder_size -= size
+
+	def compile_theme(self, colour_scheme, frame_layout):
+		# The compiled theme is kept for as long as the same colour scheme and frame layout are being drawn
+		theme = getattr(self, '_compiled_theme', None)
+		if theme is None or theme.colour_scheme is not colour_scheme or theme.frame_layout is not frame_layout or theme.domain_index != self.med_ref_deck.domain_index:
+			theme = self._compiled_theme = MedRefTheme(colour_scheme, frame_layout, self.med_ref_deck.domain_index)
+		return theme
+
+	@profiled
 	def draw_card_face(self, c, card_face, domain, colour_scheme, frame_layout, face_nr, x_offset = 0, y_offset = 0):
-		if domain in colour_scheme:
-			colour = (float(colour_scheme[domain][0])/255, float(colour_scheme[domain][1]/255), float(colour_scheme[domain][2]/255))
+		theme = self.compile_theme(colour_scheme, frame_layout)
+
+		c.saveState()
+		c.translate(x_offset, y_offset)
+
+		# Colour frame, key ring cut-out, domain text and footer, shared by all cards of a domain
+		c.doForm(theme.frame_form(c, domain, face_nr))
+
+		# Header text
+		if len(card_face.header) < 23:
+			c.setFont('Helvetica-Bold', 20, leading = None)
+		elif len(card_face.header) < 36:
+			c.setFont('Helvetica-Bold', 19, leading = None)
 		else:
-			logging.warning('No colour defined for domain: ' + domain + ', in colour scheme.')
-			colour = (0.5, 0.5, 0.5)
+			c.setFont('Helvetica-Bold', 18, leading = None)
 
-		nr_of_domains = len(self.med_ref_deck.domain_index)
-		this_domain_index = self.med_ref_deck.domain_index.index(domain)
+		c.setFillColorRGB(1, 1, 1)
+		c.drawCentredString(theme.card_width/2, theme.card_height - 1.2*cm, card_face.header)
+
+		# Include contents
+		if os.path.isfile(card_face.content_path):
+			c.setFillColorRGB(0, 0, 0)
+			page = self.content_cache.get(self.face_content_path(card_face, frame_layout))
+			c.translate(theme.border['left'], theme.border['bottom'])
+			c.doForm(makerl(c, page))
+
+		c.restoreState()
+
+
+class MedRefTheme():
+	"""Colour scheme and frame layout, compiled to points for drawing card frames"""
+	def __init__(self, colour_scheme, frame_layout, domain_index):
+		self.colour_scheme = colour_scheme
+		self.frame_layout = frame_layout
+		self.domain_index = list(domain_index)
+		self.domain_positions = dict((domain, position) for position, domain in enumerate(self.domain_index))
+		self.nr_of_domains = len(self.domain_index)
+
+		# Frame geometry in points
+		self.card_width = frame_layout['card']['width']*cm
+		self.card_height = frame_layout['card']['height']*cm
+		self.content_width = frame_layout['content']['width']*cm
+		self.content_height = frame_layout['content']['height']*cm
+		self.border = dict((key, value*cm) for key, value in frame_layout['border'].items())
+		self.key_ring_radius = frame_layout['key_ring']['radius']*cm
+
+		# Key ring cut-out: top left on the front face, top right on the back face
+		if frame_layout['output'] in ('spread', 'double-sided'):
+			back_key_ring_x = self.card_width
+		else:
+			back_key_ring_x = frame_layout['card_spread']['width']*cm
+		self.key_ring_centres = {1: (0, self.card_height), 2: (back_key_ring_x, self.card_height)}
+
+		# Sheets that double-sided output is imposed on
+		self.imposition = MedRefImposition(frame_layout) if frame_layout['output'] == 'double-sided' else None
+
+		# Footer index tabs
+		self.footer_offset = self.border['bottom'] * 0.4
+		if self.nr_of_domains > 0:
+			self.tab_width = self.card_width / self.nr_of_domains
+		self.tab_height = self.border['bottom'] - self.border['inner_corner_radius']
+
+		self.colours = {}
+		for domain in self.domain_index:
+			self.colours[domain] = self.domain_colour(domain)
+
+	def domain_colour(self, domain):
+		if domain in self.colour_scheme:
+			return (float(self.colour_scheme[domain][0])/255, float(self.colour_scheme[domain][1]/255), float(self.colour_scheme[domain][2]/255))
+		logging.warning('No colour defined for domain: ' + domain + ', in colour scheme.')
+		return (0.5, 0.5, 0.5)
+
+	def frame_form(self, c, domain, face_nr):
+		# Each frame is defined once per pdf, and then referenced by every card face of the domain
+		form_name = 'medref-frame-' + str(self.domain_positions[domain]) + '-' + str(face_nr)
+		if not c.hasForm(form_name):
+			c.beginForm(form_name, 0, 0, self.card_width, self.card_height)
+			self.draw_frame(c, domain, face_nr)
+			c.endForm()
+		return form_name
+
+	def draw_frame(self, c, domain, face_nr):
+		colour = self.colours[domain]
+		this_domain_index = self.domain_positions[domain]
+		border = self.border
 
 		# Colour frame
 		c.setFillColorRGB(colour[0], colour[1], colour[2])
-		if frame_layout['footer_index']:
-			c.roundRect(0 + x_offset,
-						0 + frame_layout['border']['bottom']*cm * 0.4 + y_offset,
-						frame_layout['card']['width']*cm,
-						frame_layout['card']['height']*cm - frame_layout['border']['bottom']*cm * 0.4,
-						radius=frame_layout['border']['outer_corner_radius']*cm, stroke=0, fill=1)
-
-			if this_domain_index == 0 and face_nr == 1 or this_domain_index == nr_of_domains-1 and face_nr == 2:
-				c.rect(	0 + x_offset,
-						0 + frame_layout['border']['bottom']*cm * 0.4 + y_offset,
-						frame_layout['border']['outer_corner_radius']*cm,
-						frame_layout['border']['outer_corner_radius']*cm,
-						stroke=0, fill=1)
-
-			if this_domain_index == nr_of_domains-1 and face_nr == 1 or this_domain_index == 0 and face_nr == 2:
-				c.rect(	frame_layout['border']['left']*cm + frame_layout['content']['width']*cm + frame_layout['border']['right']*cm - frame_layout['border']['outer_corner_radius']*cm + x_offset,
-						0 + frame_layout['border']['bottom']*cm * 0.4 + y_offset,
-						frame_layout['border']['outer_corner_radius']*cm,
-						frame_layout['border']['outer_corner_radius']*cm,
-						stroke=0, fill=1)
+		if self.frame_layout['footer_index']:
+			c.roundRect(0, self.footer_offset, self.card_width, self.card_height - self.footer_offset,
+						radius=border['outer_corner_radius'], stroke=0, fill=1)
+
+			if this_domain_index == 0 and face_nr == 1 or this_domain_index == self.nr_of_domains-1 and face_nr == 2:
+				c.rect(0, self.footer_offset, border['outer_corner_radius'], border['outer_corner_radius'], stroke=0, fill=1)
+
+			if this_domain_index == self.nr_of_domains-1 and face_nr == 1 or this_domain_index == 0 and face_nr == 2:
+				c.rect(self.card_width - border['outer_corner_radius'], self.footer_offset,
+					   border['outer_corner_radius'], border['outer_corner_radius'], stroke=0, fill=1)
 		else:
-			c.roundRect(0 + x_offset, 0 + y_offset, frame_layout['card']['width']*cm, frame_layout['card']['height']*cm, radius=frame_layout['border']['outer_corner_radius']*cm, stroke=0, fill=1)
+			c.roundRect(0, 0, self.card_width, self.card_height, radius=border['outer_corner_radius'], stroke=0, fill=1)
 
 		# Content space
 		c.setFillColorRGB(1, 1, 1)
-		c.roundRect(frame_layout['border']['left']*cm - 0*frame_layout['border']['inner_corner_radius']*cm + x_offset,
-					frame_layout['border']['bottom']*cm - 0*frame_layout['border']['inner_corner_radius']*cm + y_offset,
-					frame_layout['content']['width']*cm + 0*frame_layout['border']['inner_corner_radius']*cm,
-					frame_layout['content']['height']*cm + 0*frame_layout['border']['inner_corner_radius']*cm,
-					radius=frame_layout['border']['inner_corner_radius']*cm, stroke=0, fill=1)
-
-		# Key ring cut-out: 0 = none, 1 = top left, 2 = top right
-		if face_nr == 1:
-			c.circle(0 + x_offset, frame_layout['card_spread']['height']*cm + y_offset, frame_layout['key_ring']['radius']*cm, stroke=0, fill=1)
-		elif face_nr == 2:
-			if frame_layout['output'] == 'double-sided':
-				c.circle(frame_layout['card']['width']*cm + x_offset, frame_layout['card']['height']*cm + y_offset, frame_layout['key_ring']['radius']*cm, stroke=0, fill=1)
-			else:
-				c.circle(frame_layout['card_spread']['width']*cm, frame_layout['card_spread']['height']*cm + y_offset, frame_layout['key_ring']['radius']*cm, stroke=0, fill=1)
+		c.roundRect(border['left'], border['bottom'], self.content_width, self.content_height,
+					radius=border['inner_corner_radius'], stroke=0, fill=1)
+
+		# Key ring cut-out
+		key_ring_x, key_ring_y = self.key_ring_centres[face_nr]
+		c.circle(key_ring_x, key_ring_y, self.key_ring_radius, stroke=0, fill=1)
 
 		# Domain / Caetgory text
 		c.setFont('Helvetica', 10, leading = None)
-
-		c.drawCentredString(frame_layout['card']['width']*cm/2 + x_offset, frame_layout['card']['height']*cm - 0.48*cm + y_offset, '- ' + xtitle(domain) + ' -')
-
-		# Header text
-		if len(card_face.header) < 23:
-			c.setFont('Helvetica-Bold', 20, leading = None)
-		elif len(card_face.header) < 36:
-			c.setFont('Helvetica-Bold', 19, leading = None)
-		else:
-			c.setFont('Helvetica-Bold', 18, leading = None)
-
-		c.drawCentredString(frame_layout['card']['width']*cm/2 + x_offset, frame_layout['card']['height']*cm - 1.2*cm + y_offset, card_face.header)
+		c.drawCentredString(self.card_width/2, self.card_height - 0.48*cm, '- ' + xtitle(domain) + ' -')
 
 		# Footer
-		if frame_layout['footer_index']:
-			width = (frame_layout['border']['left']*cm + frame_layout['content']['width']*cm + frame_layout['border']['right']*cm) / nr_of_domains
-			height = frame_layout['border']['bottom']*cm - frame_layout['border']['inner_corner_radius']*cm
-			x_pos_1 = x_offset + this_domain_index * width
-			x_pos_2 = x_offset + frame_layout['border']['left']*cm + frame_layout['content']['width']*cm + frame_layout['border']['right']*cm - (this_domain_index+1) * width
-			y_pos = 0 + y_offset
-
+		if self.frame_layout['footer_index']:
 			c.setFillColorRGB(colour[0], colour[1], colour[2])
 
 			if face_nr == 1:
-				c.roundRect(x_pos_1, y_pos, width, height, radius=0.06*cm, stroke=0, fill=1)
+				c.roundRect(this_domain_index * self.tab_width, 0, self.tab_width, self.tab_height, radius=0.06*cm, stroke=0, fill=1)
 			if face_nr == 2:
-				c.roundRect(x_pos_2, y_pos, width, height, radius=0.06*cm, stroke=0, fill=1)
+				c.roundRect(self.card_width - (this_domain_index+1) * self.tab_width, 0, self.tab_width, self.tab_height, radius=0.06*cm, stroke=0, fill=1)
 		else:
 			c.setFillColorRGB(1, 1, 1)
 			c.setFont('Helvetica', 7, leading = None)
-			c.drawCentredString(frame_layout['card']['width']*cm/2 + x_offset, 0.14*cm + y_offset, frame_layout['static_text']['footer'])
+			c.drawCentredString(self.card_width/2, 0.14*cm, self.frame_layout['static_text']['footer'])
+
+class MedRefPdfStreamWriter():
+	"""Writes pdf pages to a file as they are added, and the page tree, outline and cross-reference table when closed"""
+	# Object 1 is the catalogue and object 2 the page tree, so that pages can refer to their parent before it is written
+	CATALOGUE = 1
+	PAGE_TREE = 2
+
+	def __init__(self, output_path):
+		self.output_path = output_path
+		self.file = open(output_path, 'wb')
+		self.offsets = [None, None]
+		self.page_refs = []
+		self.toc_items = []
+		self.info = None
+		self.numbers = {}
+		self.pending = []
+
+		self.write('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
 
-		# Include contents
-		if os.path.isfile(card_face.content_path):
-			c.setFillColorRGB(0, 0, 0)
-			page = pagexobj(PdfReader(card_face.content_path).pages[0])
-			c.saveState()
-			c.translate(frame_layout['border']['left']*cm + x_offset, frame_layout['border']['bottom']*cm + y_offset)
-			c.doForm(makerl(c, page))
-			c.restoreState()
+	def __repr__(self):
+		return repr((self.output_path, len(self.page_refs), len(self.toc_items)))
+
+	def write(self, text):
+		self.file.write(text.encode('latin-1'))
+
+	def reserve(self):
+		self.offsets.append(None)
+		return len(self.offsets)
+
+	def write_object(self, number, text):
+		self.offsets[number - 1] = self.file.tell()
+		self.write(str(number) + ' 0 obj\n' + text + '\nendobj\n')
+
+	def reference(self, pdf_obj):
+		# Indirect objects are written once per chunk, after the object that first refers to them
+		number = self.numbers.get(id(pdf_obj))
+		if number is None:
+			number = self.numbers[id(pdf_obj)] = self.reserve()
+			self.pending.append((number, pdf_obj))
+		return str(number) + ' 0 R'
+
+	def format_value(self, pdf_obj):
+		if isinstance(pdf_obj, PdfDict):
+			indirect = pdf_obj.indirect or pdf_obj.stream is not None
+		else:
+			indirect = isinstance(pdf_obj, PdfArray) and pdf_obj.indirect
+		if indirect:
+			return self.reference(pdf_obj)
+		return self.format_object(pdf_obj)
+
+	def format_object(self, pdf_obj):
+		if isinstance(pdf_obj, PdfDict):
+			text = '<<' + ''.join(' ' + (getattr(key, 'encoded', None) or key) + ' ' + self.format_value(value) for key, value in pdf_obj.iteritems()) + ' >>'
+			if pdf_obj.stream is not None:
+				text += '\nstream\n' + pdf_obj.stream + '\nendstream'
+			return text
+		if isinstance(pdf_obj, (PdfArray, list)):
+			return '[' + ' '.join(self.format_value(value) for value in pdf_obj) + ']'
+		if hasattr(pdf_obj, 'indirect'):
+			return str(getattr(pdf_obj, 'encoded', None) or pdf_obj)
+		return user_fmt(pdf_obj)
+
+	def add_pages(self, pdf_path, toc_items=()):
+		# Copy the pages of a pdf, with everything they use, and move its outline entries to the pages they now have
+		reader = PdfReader(pdf_path)
+		self.numbers = {}
+		self.toc_items.extend((title, level, closed, len(self.page_refs) + page_nr) for title, level, closed, page_nr in toc_items)
+		if self.info is None and reader.Info is not None:
+			self.info = self.reference(reader.Info)
+
+		for page in reader.pages:
+			for key in ('Resources', 'MediaBox', 'CropBox', 'Rotate'):
+				if page[PdfName(key)] is None and page.inheritable[PdfName(key)] is not None:
+					page[PdfName(key)] = page.inheritable[PdfName(key)]
+			page.Parent = PdfObject(str(self.PAGE_TREE) + ' 0 R')
+			self.page_refs.append(self.reference(page))
+
+		while len(self.pending) > 0:
+			number, pdf_obj = self.pending.pop()
+			self.write_object(number, self.format_object(pdf_obj))
+		self.numbers = {}
+
+	def write_outline(self):
+		# Nest the outline entries by level, like reportlab does, with direct destinations instead of named ones
+		root = {'children': []}
+		stack = [root]
+		for title, level, closed, page_nr in self.toc_items:
+			del stack[level + 1:]
+			item = {'title': title, 'closed': closed, 'page_nr': page_nr, 'children': [], 'number': self.reserve()}
+			stack[-1]['children'].append(item)
+			stack.append(item)
+		root['number'] = self.reserve()
+
+		def visible(item):
+			return sum(1 + (visible(child) if not child['closed'] else 0) for child in item['children'])
+
+		def write_items(parent):
+			children = parent['children']
+			for position, item in enumerate(children):
+				text = '<< /Title ' + PdfString.encode(item['title']) + ' /Parent ' + str(parent['number']) + ' 0 R'
+				text += ' /Dest [' + self.page_refs[item['page_nr']] + ' /Fit]'
+				if position > 0:
+					text += ' /Prev ' + str(children[position - 1]['number']) + ' 0 R'
+				if position < len(children) - 1:
+					text += ' /Next ' + str(children[position + 1]['number']) + ' 0 R'
+				if len(item['children']) > 0:
+					text += ' /First ' + str(item['children'][0]['number']) + ' 0 R /Last ' + str(item['children'][-1]['number']) + ' 0 R'
+					text += ' /Count ' + str(-visible(item) if item['closed'] else visible(item))
+				self.write_object(item['number'], text + ' >>')
+				write_items(item)
+
+		write_items(root)
+		text = '<< /Type /Outlines /Count ' + str(visible(root))
+		if len(root['children']) > 0:
+			text += ' /First ' + str(root['children'][0]['number']) + ' 0 R /Last ' + str(root['children'][-1]['number']) + ' 0 R'
+		self.write_object(root['number'], text + ' >>')
+		return root['number']
+
+	def close(self):
+		outline = self.write_outline()
+		self.write_object(self.PAGE_TREE, '<< /Type /Pages /Count ' + str(len(self.page_refs)) + ' /Kids [' + ' '.join(self.page_refs) + '] >>')
+		self.write_object(self.CATALOGUE, '<< /Type /Catalog /Pages ' + str(self.PAGE_TREE) + ' 0 R /Outlines ' + str(outline) + ' 0 R >>')
+
+		xref_offset = self.file.tell()
+		self.write('xref\n0 ' + str(len(self.offsets) + 1) + '\n0000000000 65535 f\r\n')
+		for offset in self.offsets:
+			self.write('%010d 00000 n\r\n' % offset)
+
+		trailer = '<< /Size ' + str(len(self.offsets) + 1) + ' /Root ' + str(self.CATALOGUE) + ' 0 R'
+		if self.info is not None:
+			trailer += ' /Info ' + self.info
+		self.write('trailer\n' + trailer + ' >>\nstartxref\n' + str(xref_offset) + '\n%%EOF\n')
+		self.file.close()
+
+
+# Decks available to a worker process, by localisation
+_worker_med_ref_cards = {}
+
+def _init_worker(med_ref_cards_by_localisation, profile=False, trace_memory=False):
+	_worker_med_ref_cards.update(med_ref_cards_by_localisation)
+
+	# Forked workers start from a copy of the parent's profile
+	profiler.reset()
+	if profile:
+		profiler.start(trace_memory)
+
+	# Only the parent process writes to the on-disk content cache
+	for med_ref_cards in _worker_med_ref_cards.values():
+		med_ref_cards.content_cache.read_only = True
+
+def _generate_pdf_worker(localisation, pdf_args):
+	start_time = time.time()
+	med_ref_cards = _worker_med_ref_cards[localisation]
+	output_path = med_ref_cards.generate_pdf(**pdf_args)
+
+	# Each task hands back the profile of its own build
+	report = None
+	if profiler.enabled:
+		report = profiler.report()
+		profiler.reset()
+
+	return output_path, time.time() - start_time, report, med_ref_cards.optimisation
+
+def generate_pdfs(med_ref_cards_list, frame_layouts, colour_scheme='default-colour-scheme', output_folder='../pdf', jobs=None, force=False, optimise=False, stream_pages=None, split=None):
+	"""Generate one pdf per deck and frame layout, spread over a pool of worker processes"""
+	med_ref_cards_by_localisation = {}
+	for med_ref_cards in med_ref_cards_list:
+		med_ref_cards_by_localisation[med_ref_cards.med_ref_deck.localisation] = med_ref_cards
+
+		if med_ref_cards.content_cache.cache_file is not None:
+			med_ref_cards.warm_content_cache()
+
+	timings = []
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(med_ref_cards_by_localisation, profiler.enabled, profiler.trace_memory)) as executor:
+		futures = []
+		for localisation in med_ref_cards_by_localisation:
+			for frame_layout in frame_layouts:
+				pdf_args = {'colour_scheme': colour_scheme, 'frame_layout': frame_layout, 'output_folder': output_folder, 'force': force, 'optimise': optimise, 'stream_pages': stream_pages, 'split': split}
+				futures.append(executor.submit(_generate_pdf_worker, localisation, pdf_args))
+
+		for future in futures:
+			output_path, seconds, report, optimisation = future.result()
+			if report is not None:
+				profiler.merge(report)
+			timings.append((output_path, seconds, optimisation))
+
+	return timings
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+# Conversion of card sources to the content pdf:s of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# The source of a content pdf is the file in the source folder of the card with the same name,
+# e.g. source/medicine-af-chadsvas-front.docx for medicine-af-chadsvas-front.pdf. Other files in
+# the source folders (images, spreadsheets, shared documents) are left alone.
+#
+# The converter is a command with placeholders, run once per stale source:
+#
+#   {source}   the source file
+#   {outdir}   an empty folder, that the pdf is written to
+#   {output}   the pdf expected in it: {outdir}/<source name>.pdf
+#   {slot}     the number of the worker
+#   {profile}  a private folder of the user for the worker, as a file url, for separate LibreOffice
+#              profiles (~/.cache/medical-reference-cards/soffice/slot-<slot> by default)
+#
+# The conversion manifest records the hash of each source at its last conversion, with paths
+# relative to the content folder, so that it can be committed and shared. A source is stale when
+# its hash has changed since then, or when its pdf is missing. A pdf without a record is taken to be
+# converted from its source as it is, and recorded, as modification times say nothing after a
+# checkout; convert with --force to convert those sources anyway.
+
+import os, time, json, shlex, shutil, logging, pathlib, tempfile, subprocess, queue, concurrent.futures
+
+import MedRefDeck
+
+DEFAULT_CONVERTER = 'soffice -env:UserInstallation={profile} --headless --convert-to pdf --outdir {outdir} {source}'
+DEFAULT_PROFILE_FOLDER = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'medical-reference-cards', 'soffice')
+DEFAULT_EXTENSIONS = ('.docx', '.doc', '.odt', '.rtf')
+
+
+class MedRefConversionManifest():
+	"""Hashes of the sources at their last conversion, keyed by content pdf relative to the content folder"""
+	version = 1
+
+	def __init__(self, manifest_file):
+		self.manifest_file = manifest_file
+		self.conversions = {}
+
+		if os.path.isfile(manifest_file):
+			try:
+				with open(manifest_file, 'r') as file_descriptor:
+					data = json.load(file_descriptor)
+				if data.get('version') == self.version:
+					self.conversions = data['conversions']
+			except ValueError:
+				logging.warning('Unreadable conversion manifest: ' + manifest_file + '. Taking the existing pdf:s to be up to date.')
+
+	def __repr__(self):
+		return repr((self.manifest_file, sorted(self.conversions.keys())))
+
+	def save(self):
+		temp_path = self.manifest_file + '.' + str(os.getpid()) + '.tmp'
+		with open(temp_path, 'w') as file_descriptor:
+			json.dump({'version': self.version, 'conversions': self.conversions}, file_descriptor, indent=1, sort_keys=True)
+		os.replace(temp_path, self.manifest_file)
+
+
+class MedRefConverter():
+	"""Converts the stale card sources of some localisations, in a bounded pool of converter processes"""
+	def __init__(self, content_path='../contents', localisations=('eng',), converter=DEFAULT_CONVERTER, extensions=DEFAULT_EXTENSIONS,
+				 manifest_file=None, jobs=None, timeout=300, profile_folder=None):
+		self.content_path = content_path
+		self.localisations = list(localisations)
+		self.converter = converter
+		self.extensions = [extension if extension.startswith('.') else '.' + extension for extension in extensions]
+		self.jobs = jobs or os.cpu_count() or 1
+		self.timeout = timeout
+		self.profile_folder = profile_folder or DEFAULT_PROFILE_FOLDER
+
+		if manifest_file is None:
+			manifest_file = os.path.join(content_path, 'conversion-manifest.json')
+		self.manifest = MedRefConversionManifest(manifest_file)
+
+	def __repr__(self):
+		return repr((self.content_path, self.localisations, self.converter, self.manifest))
+
+	def find_sources(self):
+		# Return (source, content pdf) for every card face with a source, in card order
+		sources = []
+		for localisation in self.localisations:
+			for card_file in MedRefDeck.find_files(os.path.join(self.content_path, localisation), '*.yml'):
+				card_folder, card_name = os.path.split(card_file[:-len('.yml')])
+				source_folder = os.path.join(card_folder, 'source')
+				if not os.path.isdir(source_folder):
+					continue
+
+				for side in ('front', 'back'):
+					for extension in self.extensions:
+						source = os.path.join(source_folder, card_name + '-' + side + extension)
+						if os.path.isfile(source):
+							sources.append((source, os.path.join(card_folder, card_name + '-' + side + '.pdf')))
+							break
+		return sources
+
+	def key(self, content_pdf):
+		return os.path.relpath(content_pdf, self.content_path).replace(os.sep, '/')
+
+	def is_stale(self, source, content_pdf):
+		if not os.path.isfile(content_pdf):
+			return True
+
+		conversion = self.manifest.conversions.get(self.key(content_pdf))
+		if conversion is not None:
+			return conversion['source_hash'] != MedRefDeck.file_hash(source) or conversion['converter'] != self.converter
+
+		return False
+
+	def convert(self, source, content_pdf, slot):
+		# Run the converter in an empty folder and move the pdf into place, so that a failed conversion leaves the old pdf
+		start_time = time.time()
+		profile = self.profile(slot)
+		outdir = tempfile.mkdtemp(prefix='medical-reference-cards-convert-')
+		try:
+			output = os.path.join(outdir, os.path.splitext(os.path.basename(source))[0] + '.pdf')
+			values = {'source': os.path.abspath(source), 'outdir': outdir, 'output': output, 'slot': str(slot), 'profile': profile}
+			command = [part.format(**values) for part in shlex.split(self.converter)]
+
+			result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=self.timeout)
+			if result.returncode != 0:
+				raise RuntimeError('exit status ' + str(result.returncode) + ': ' + result.stdout.decode('utf-8', 'replace').strip()[-500:])
+			if not os.path.isfile(output):
+				raise RuntimeError('no pdf written to ' + output)
+
+			shutil.move(output, content_pdf)
+		finally:
+			shutil.rmtree(outdir, ignore_errors=True)
+
+		return time.time() - start_time
+
+	def profile(self, slot):
+		# Return the file url of the profile folder of a slot. The folders are created private to the user,
+		# so that no one else can prepare a profile for the converter to run.
+		if '{profile}' not in self.converter:
+			return ''
+
+		os.makedirs(os.path.dirname(os.path.abspath(self.profile_folder)), mode=0o700, exist_ok=True)
+		os.makedirs(self.profile_folder, mode=0o700, exist_ok=True)
+		profile_path = os.path.join(os.path.abspath(self.profile_folder), 'slot-' + str(slot))
+		os.makedirs(profile_path, mode=0o700, exist_ok=True)
+		return pathlib.Path(profile_path).as_uri()
+
+	def conversion(self, source, content_pdf):
+		return {
+			'source': self.key(source),
+			'source_hash': MedRefDeck.file_hash(source),
+			'pdf_hash': MedRefDeck.file_hash(content_pdf),
+			'converter': self.converter
+		}
+
+	def run(self, force=False):
+		"""Convert the stale sources, or all of them when forced, and return (source, content pdf, seconds, error) for each"""
+		stale = []
+		changed = False
+		for source, content_pdf in self.find_sources():
+			if force or self.is_stale(source, content_pdf):
+				stale.append((source, content_pdf))
+			elif self.key(content_pdf) not in self.manifest.conversions:
+				# Taken to be up to date, from now on compared by hash
+				self.manifest.conversions[self.key(content_pdf)] = self.conversion(source, content_pdf)
+				changed = True
+		logging.info(str(len(stale)) + ' stale source(s)')
+
+		# Each running conversion holds a slot number, that the converter command can use
+		slots = queue.Queue()
+		for slot in range(self.jobs):
+			slots.put(slot)
+
+		def convert_in_slot(source, content_pdf):
+			slot = slots.get()
+			try:
+				return self.convert(source, content_pdf, slot)
+			finally:
+				slots.put(slot)
+
+		results = []
+		with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+			futures = [(source, content_pdf, executor.submit(convert_in_slot, source, content_pdf)) for source, content_pdf in stale]
+			for source, content_pdf, future in futures:
+				try:
+					seconds = future.result()
+				except (OSError, RuntimeError, subprocess.TimeoutExpired) as error:
+					results.append((source, content_pdf, None, str(error)))
+					continue
+
+				self.manifest.conversions[self.key(content_pdf)] = self.conversion(source, content_pdf)
+				changed = True
+				results.append((source, content_pdf, seconds, None))
+
+		if changed:
+			self.manifest.save()
+
+		return results
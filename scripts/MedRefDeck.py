@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+# Card descriptions and decks of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Everything here only reads the card descriptions and the theme, so that listing cards, domains and
+# frame layouts does not import reportlab and pdfrw. MedRefCards draws the decks.
+
+# Used for finding all the yaml files corresponding to the cards in the content folder and for logging
+import os, fnmatch, re, logging
+
+# Used for the content hashes of card, content and theme files
+import hashlib
+
+# Used for the card catalogue, that keeps parsed card descriptions between runs
+import json
+
+# Uses yaml to process yaml files with card information, with the C loader when libyaml is available
+import yaml
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Card filter expressions and the per field card indexes they are evaluated against
+from MedRefFilter import MedRefCardFilter, MedRefCardIndex
+
+# Profiler shared by the whole build
+from MedRefProfile import profiler, profiled
+
+
+# Load and return yaml data
+@profiled
+def yaml_loader(filepath):
+	with open(filepath, 'r') as file_descriptor:
+		data = yaml.load(file_descriptor, Loader=YamlLoader)
+		file_descriptor.close()
+	return data
+
+
+# Dump yaml data to file
+def yaml_dump(filepath, data):
+	with open(filepath, 'w') as file_descriptor:
+		yaml.dump(data, file_descriptor)
+		file_descriptor.close()
+
+# Return the sha1 hex digest of a file, or None if there is no such file
+# Digests are remembered by path, and only recomputed when the modification time or size changes
+_file_hashes = {}
+
+def file_hash(filepath):
+	if not os.path.isfile(filepath):
+		return None
+	stat = os.stat(filepath)
+	signature = (stat.st_mtime_ns, stat.st_size)
+	if filepath in _file_hashes and _file_hashes[filepath][0] == signature:
+		return _file_hashes[filepath][1]
+
+	sha1 = hashlib.sha1()
+	with open(filepath, 'rb') as file_descriptor:
+		for block in iter(lambda: file_descriptor.read(1 << 20), b''):
+			sha1.update(block)
+	_file_hashes[filepath] = (signature, sha1.hexdigest())
+	return sha1.hexdigest()
+
+# Walks a content folder in the same order as os.walk, without descending into source folders
+def find_files(path, pattern, result=None):
+	if result is None:
+		result = []
+
+	folders = []
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.is_dir():
+				if entry.name != 'source':
+					folders.append(entry.path)
+			elif fnmatch.fnmatch(entry.name, pattern):
+				result.append(entry.path)
+
+	for folder in folders:
+		find_files(folder, pattern, result)
+
+	return result
+
+# Add the card and card spread sizes that follow from the content and border of a frame layout
+def set_frame_layout(frame_layout):
+	frame_layout['card'] = {
+		'width': frame_layout['border']['left'] + frame_layout['content']['width'] + frame_layout['border']['right'],
+		'height': frame_layout['border']['top'] + frame_layout['content']['height'] + frame_layout['border']['bottom']
+	}
+
+	frame_layout['card_spread'] = {
+		'width': 2 * frame_layout['card']['width'],
+		'height': frame_layout['card']['height']
+	}
+
+	return frame_layout
+
+def xtitle(string):
+		return string.title().replace('And', 'and')
+
+
+class MedRefCardFace():
+	"""Medical Reference Card Face"""
+	def __init__(self, header, content_path, footer, toc, references):
+		self.header = header
+		self.content_path = content_path
+		self.footer = footer
+		self.toc = toc
+		self.references = references
+
+	def __repr__(self):
+		return repr((self.header, self.content_path, self.footer, self.toc, self.references))
+
+
+class MedRefCard():
+	"""Medical Reference Card"""
+	def __init__(self, card_file, card_dict=None):
+		if card_dict is None:
+			card_dict = yaml_loader(card_file)
+
+		# Remove file name and .yml extention to create path
+		path_reg_ex = re.search(r'(?P<path>.*/).+\.yml', card_file)
+		# Remove file path and .yml extention to create filename
+		fn_reg_ex = re.search(r'.*/(?P<fn>.+)\.yml', card_file)
+
+		self.card_file = card_file
+		self.card_dict = card_dict
+		self.card_folder = path_reg_ex.group('path')
+		self.card_fn = fn_reg_ex.group('fn')
+
+		self.domain = card_dict['domain'].lower()
+		self.category = card_dict['category'].lower()
+
+		self.modified_date = card_dict['modified_date']
+		self.verified_date = card_dict['verified_date']
+		self.verified_by = card_dict['verified_by']
+
+		self.front_face = MedRefCardFace(
+			card_dict['front_header'],
+			os.path.join(self.card_folder, self.card_fn + '-front.pdf'),
+			card_dict['front_footer'],
+			card_dict['front_toc'],
+			card_dict['front_references']
+		)
+
+		self.back_face = MedRefCardFace(
+			card_dict['back_header'],
+			os.path.join(self.card_folder, self.card_fn + '-back.pdf'),
+			card_dict['back_footer'],
+			card_dict['back_toc'],
+			card_dict['back_references']
+		)
+
+		def __repr__(self):
+			return repr((self.card_folder, self.card_fn, self.domain, self.category, self.modified_date, self.verified_date,
+				self.verified_by, self.front_face, self.back_face))
+
+
+class MedRefCatalogue():
+	"""Catalogue of parsed card descriptions, keyed by path and refreshed by modification time and size"""
+	version = 1
+
+	def __init__(self, catalogue_file=None):
+		self.catalogue_file = catalogue_file
+		self.cards = {}
+		self.changed = False
+
+		if catalogue_file is not None and os.path.isfile(catalogue_file):
+			try:
+				with open(catalogue_file, 'r') as file_descriptor:
+					data = json.load(file_descriptor)
+				if data.get('version') == self.version:
+					self.cards = data['cards']
+			except ValueError:
+				logging.warning('Unreadable card catalogue: ' + catalogue_file + '. Rebuilding it.')
+
+	def __repr__(self):
+		return repr((self.catalogue_file, sorted(self.cards.keys())))
+
+	def card_dict(self, card_file):
+		stat = os.stat(card_file)
+		signature = [stat.st_mtime_ns, stat.st_size]
+
+		entry = self.cards.get(card_file)
+		if entry is not None and entry['signature'] == signature:
+			return entry['card']
+
+		# Stale or new card, stored as it reads back from json so that both paths return the same values
+		card_dict = json.loads(json.dumps(yaml_loader(card_file), default=str))
+		self.cards[card_file] = {'signature': signature, 'card': card_dict}
+		self.changed = True
+		return card_dict
+
+	def prune(self, content_path, card_files):
+		# Forget cards that have been removed from a content folder
+		card_files = set(card_files)
+		content_prefix = os.path.join(content_path, '')
+		for card_file in list(self.cards.keys()):
+			if card_file.startswith(content_prefix) and card_file not in card_files:
+				del self.cards[card_file]
+				self.changed = True
+
+	def save(self):
+		if self.catalogue_file is None or not self.changed:
+			return
+		temp_path = self.catalogue_file + '.' + str(os.getpid()) + '.tmp'
+		with open(temp_path, 'w') as file_descriptor:
+			json.dump({'version': self.version, 'cards': self.cards}, file_descriptor, separators=(',', ':'))
+		os.replace(temp_path, self.catalogue_file)
+		self.changed = False
+
+
+class MedRefDeck():
+	"""Medical Reference Card Deck"""
+
+	def __init__(self, localisation, card_filter, content_path, catalogue=None):
+		self.localisation = localisation
+		self.card_filter = card_filter
+		self.content_path = os.path.join(content_path, localisation)
+		self.cards = []
+		self.domain_index = []
+
+		if catalogue is None:
+			catalogue = MedRefCatalogue()
+
+		with profiler.stage('discovery'):
+			card_files = self.find_all_cards()
+		card_dicts = [catalogue.card_dict(card_file) for card_file in card_files]
+
+		# Only the cards selected by the card filter are turned into MedRefCards
+		selected = MedRefCardFilter(card_filter).select(MedRefCardIndex(card_dicts))
+
+		# Create a list of all MedRefCards
+		active_domain = ''
+		for card_nr in selected:
+			self.cards.append(MedRefCard(card_files[card_nr], card_dicts[card_nr]))
+			if self.cards[-1].domain != active_domain:
+				self.domain_index.append(self.cards[-1].domain)
+				active_domain = self.cards[-1].domain
+
+		catalogue.prune(self.content_path, card_files)
+		catalogue.save()
+
+		self.card_index = MedRefCardIndex([card.card_dict for card in self.cards])
+		self.card_positions = dict((card.card_fn, card_nr) for card_nr, card in enumerate(self.cards))
+		profiler.count('cards', len(self.cards))
+
+		logging.info('Deck generated successfully. Number of cards: ' + str(len(self.cards)))
+
+	def __repr__(self):
+		return repr((self.localisation, self.card_filter, self.content_path, self.cards))
+
+	def find_all_cards(self):
+		return find_files(self.content_path, '*.yml')
+
+	def sort(self, reverse=False):
+		self.cards = sorted(self.cards, key=lambda card: card.domain, reverse=reverse)
+		self.card_index = MedRefCardIndex([card.card_dict for card in self.cards])
+		self.card_positions = dict((card.card_fn, card_nr) for card_nr, card in enumerate(self.cards))
+
+
+def list_theme_files(theme_path, theme_folder):
+	theme_files = []
+	for name in sorted(os.listdir(os.path.join(theme_path, theme_folder))):
+		if fnmatch.fnmatch(name, '*.yml'):
+			theme_files.append(name[:-len('.yml')])
+	return theme_files
+
+def list_frame_layouts(theme_path='../theme'):
+	return list_theme_files(theme_path, 'frame-layouts')
+
+def list_colour_schemes(theme_path='../theme'):
+	return list_theme_files(theme_path, 'colour-schemes')
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+
+# Card filter expressions for medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# A card filter is an expression over the fields of the card descriptions, for example:
+#
+#   all
+#   domain=paediatrics and category=basic and verified_date>=160101
+#   domain=neurology,orthopaedics or text~glasgow
+#   not (domain='obstetrics and gynaecology' or verified_by='')
+#
+# Operators: = (equal), != (not equal), ~ (contains), <, <=, >, >= (compared as text, empty values never match)
+# Several values can be given to = and != separated by commas. Values are compared in lower case.
+
+import re, bisect
+
+FIELDS = ('domain', 'category', 'modified_date', 'verified_date', 'verified_by', 'header', 'toc', 'text')
+OPERATORS = ('=', '!=', '~', '<', '<=', '>', '>=')
+
+TOKEN_REG_EX = re.compile(r'''\s*(?:(?P<paren>[()])|(?P<operator>!=|<=|>=|=|<|>|~)|'(?P<single>[^']*)'|"(?P<double>[^"]*)"|(?P<word>[^\s()=!<>~'"]+))''')
+
+
+# Return the indexed values of a card description, by field
+def card_field_values(card_dict):
+	def text(value):
+		return '' if value is None else str(value).lower()
+
+	def text_list(values):
+		return [text(value) for value in (values or []) if text(value) != '']
+
+	headers = text_list([card_dict.get('front_header'), card_dict.get('back_header')])
+	toc = text_list(card_dict.get('front_toc')) + text_list(card_dict.get('back_toc'))
+
+	return {
+		'domain': [text(card_dict.get('domain'))],
+		'category': [text(card_dict.get('category'))],
+		'modified_date': [text(card_dict.get('modified_date'))],
+		'verified_date': [text(card_dict.get('verified_date'))],
+		'verified_by': [text(card_dict.get('verified_by'))],
+		'header': headers,
+		'toc': toc,
+		'text': headers + toc
+	}
+
+
+class MedRefCardIndex():
+	"""Per field indexes over a list of card descriptions"""
+	def __init__(self, card_dicts):
+		self.size = len(card_dicts)
+		self.fields = dict((field, {}) for field in FIELDS)
+		self.sorted_values = {}
+
+		for card_nr, card_dict in enumerate(card_dicts):
+			for field, values in card_field_values(card_dict).items():
+				for value in values:
+					self.fields[field].setdefault(value, set()).add(card_nr)
+
+	def __repr__(self):
+		return repr((self.size, dict((field, len(values)) for field, values in self.fields.items())))
+
+	def all(self):
+		return set(range(self.size))
+
+	def lookup(self, field, operator, values):
+		index = self.fields[field]
+
+		if operator == '=':
+			result = set()
+			for value in values:
+				result |= index.get(value, set())
+			return result
+
+		if operator == '!=':
+			return self.all() - self.lookup(field, '=', values)
+
+		if operator == '~':
+			result = set()
+			for indexed_value, card_nrs in index.items():
+				if any(value in indexed_value for value in values):
+					result |= card_nrs
+			return result
+
+		# Ordered comparison over the sorted values of the field
+		if field not in self.sorted_values:
+			self.sorted_values[field] = sorted(value for value in index if value != '')
+		sorted_values = self.sorted_values[field]
+		value = values[0]
+
+		if operator == '<':
+			matching = sorted_values[:bisect.bisect_left(sorted_values, value)]
+		elif operator == '<=':
+			matching = sorted_values[:bisect.bisect_right(sorted_values, value)]
+		elif operator == '>':
+			matching = sorted_values[bisect.bisect_right(sorted_values, value):]
+		else:
+			matching = sorted_values[bisect.bisect_left(sorted_values, value):]
+
+		result = set()
+		for indexed_value in matching:
+			result |= index[indexed_value]
+		return result
+
+
+class MedRefCardFilter():
+	"""Card filter expression"""
+	def __init__(self, expression='all'):
+		self.expression = expression
+		self.tokens = self.tokenise(expression)
+		self.position = 0
+		self.tree = self.parse_or()
+
+		if self.position < len(self.tokens):
+			raise ValueError('Unexpected ' + repr(self.tokens[self.position][1]) + ' in card filter: ' + expression)
+
+	def __repr__(self):
+		return repr((self.expression, self.tree))
+
+	def tokenise(self, expression):
+		tokens = []
+		position = 0
+		expression = expression.rstrip()
+		while position < len(expression):
+			match = TOKEN_REG_EX.match(expression, position)
+			if match is None or match.end() == position:
+				raise ValueError('Invalid card filter: ' + expression)
+			if match.group('paren') is not None:
+				tokens.append(('paren', match.group('paren')))
+			elif match.group('operator') is not None:
+				tokens.append(('operator', match.group('operator')))
+			elif match.group('word') is not None:
+				tokens.append(('word', match.group('word')))
+			else:
+				quoted = match.group('single') if match.group('single') is not None else match.group('double')
+				tokens.append(('quoted', quoted))
+			position = match.end()
+		return tokens
+
+	def peek(self):
+		if self.position < len(self.tokens):
+			return self.tokens[self.position]
+		return (None, None)
+
+	def take(self):
+		token = self.peek()
+		if token[0] is None:
+			raise ValueError('Unexpected end of card filter: ' + self.expression)
+		self.position += 1
+		return token
+
+	def is_keyword(self, token, keyword):
+		return token[0] == 'word' and token[1].lower() == keyword
+
+	def parse_or(self):
+		tree = self.parse_and()
+		while self.is_keyword(self.peek(), 'or'):
+			self.take()
+			tree = ('or', tree, self.parse_and())
+		return tree
+
+	def parse_and(self):
+		tree = self.parse_not()
+		while self.is_keyword(self.peek(), 'and'):
+			self.take()
+			tree = ('and', tree, self.parse_not())
+		return tree
+
+	def parse_not(self):
+		if self.is_keyword(self.peek(), 'not'):
+			self.take()
+			return ('not', self.parse_not())
+		return self.parse_atom()
+
+	def parse_atom(self):
+		token = self.take()
+
+		if token == ('paren', '('):
+			tree = self.parse_or()
+			if self.peek() != ('paren', ')'):
+				raise ValueError('Missing ) in card filter: ' + self.expression)
+			self.take()
+			return tree
+
+		if self.is_keyword(token, 'all'):
+			return ('all',)
+
+		if token[0] != 'word' or token[1].lower() not in FIELDS:
+			raise ValueError('Unknown card field ' + repr(token[1]) + ' in card filter, use one of: ' + ', '.join(FIELDS))
+		field = token[1].lower()
+
+		operator = self.take()
+		if operator[0] != 'operator':
+			raise ValueError('Expected an operator after ' + field + ' in card filter: ' + self.expression)
+
+		value = self.take()
+		if value[0] == 'quoted':
+			values = [value[1].lower()]
+		elif value[0] == 'word':
+			values = [part.lower() for part in value[1].split(',')]
+		else:
+			raise ValueError('Expected a value after ' + field + operator[1] + ' in card filter: ' + self.expression)
+
+		return ('match', field, operator[1], values)
+
+	def select(self, card_index):
+		# Return the numbers of the matching cards, in index order
+		return sorted(self.evaluate(self.tree, card_index))
+
+	def evaluate(self, tree, card_index):
+		if tree[0] == 'all':
+			return card_index.all()
+		if tree[0] == 'match':
+			return card_index.lookup(tree[1], tree[2], tree[3])
+		if tree[0] == 'not':
+			return card_index.all() - self.evaluate(tree[1], card_index)
+		if tree[0] == 'and':
+			return self.evaluate(tree[1], card_index) & self.evaluate(tree[2], card_index)
+		return self.evaluate(tree[1], card_index) | self.evaluate(tree[2], card_index)
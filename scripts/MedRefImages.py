@@ -0,0 +1,268 @@
+#!/usr/bin/python
+
+# Resampling of the images in the contents of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Frame layouts can set the resolution of the images in the card contents:
+#
+#   images:
+#     dpi: 150        # images with a higher resolution, where they are drawn, are resampled to this
+#     quality: 85     # jpeg quality of resampled jpeg images
+#
+# The size an image is drawn at is followed through the content stream of the content pdf, and
+# images and content pdf:s are only ever made smaller, in pixels and in bytes. Resampled jpeg images
+# are recompressed as jpeg, other images losslessly. Images with a colour key mask, a decode array,
+# or colours other than rgb or grey are left as they are. Without an images section, contents are
+# used as they are.
+#
+# Resampled images are cached by image hash and the size that follows from the resolution, and
+# resampled content pdf:s by content hash and resolution, so that repeated builds only look them up.
+# The cache is a folder of the user (~/.cache/medical-reference-cards/images by default), and holds
+# only image data, pdf:s and json, never anything that is run when read.
+
+import os, io, math, zlib, json, hashlib, logging
+
+# Uses pikepdf and Pillow to rewrite the images, when installed
+try:
+	import pikepdf
+	from PIL import Image
+except ImportError:
+	pikepdf = None
+
+DEFAULT_CACHE_FOLDER = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'medical-reference-cards', 'images')
+
+# Filters of resampled image data
+IMAGE_FILTERS = ('/DCTDecode', '/FlateDecode')
+DEFAULT_QUALITY = 85
+
+# Images that would keep this much of their size or more are left as they are
+MIN_SCALE = 0.9
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+
+# Return the pdf matrix m followed by n
+def multiply(m, n):
+	return (m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+			m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3],
+			m[4] * n[0] + m[5] * n[2] + n[4], m[4] * n[1] + m[5] * n[3] + n[5])
+
+
+# Record the largest size, in points, that each image is drawn at by a page or form xobject
+def drawn_sizes(container, resources, ctm, sizes, depth=0):
+	if resources is None or depth > 8:
+		return
+	xobjects = resources.get('/XObject') or {}
+
+	stack = []
+	for operands, operator in pikepdf.parse_content_stream(container):
+		operator = str(operator)
+		if operator == 'q':
+			stack.append(ctm)
+		elif operator == 'Q' and len(stack) > 0:
+			ctm = stack.pop()
+		elif operator == 'cm':
+			ctm = multiply(tuple(float(operand) for operand in operands), ctm)
+		elif operator == 'Do':
+			xobject = xobjects.get(operands[0])
+			if xobject is None:
+				continue
+
+			if xobject.get('/Subtype') == '/Image':
+				width, height = sizes.get(xobject.objgen, (0, 0))
+				sizes[xobject.objgen] = (max(width, math.hypot(ctm[0], ctm[1])), max(height, math.hypot(ctm[2], ctm[3])))
+			elif xobject.get('/Subtype') == '/Form':
+				matrix = tuple(float(value) for value in xobject.get('/Matrix', IDENTITY))
+				drawn_sizes(xobject, xobject.get('/Resources', resources), multiply(matrix, ctm), sizes, depth + 1)
+
+
+class MedRefImageResampler():
+	"""Content pdf:s with their images resampled to the resolution of a frame layout, cached on disk"""
+	def __init__(self, cache_folder=None):
+		self.cache_folder = cache_folder or DEFAULT_CACHE_FOLDER
+		self.warned = False
+
+	def __repr__(self):
+		return repr((self.cache_folder))
+
+	def content_path(self, content_path, content_hash, settings):
+		"""Return the path of the content pdf resampled to settings['dpi'], or content_path if nothing needs resampling"""
+		if pikepdf is None:
+			if not self.warned:
+				logging.warning('Images are not resampled. Install pikepdf and Pillow to resample them.')
+				self.warned = True
+			return content_path
+
+		dpi = settings['dpi']
+		quality = settings.get('quality', DEFAULT_QUALITY)
+		key = content_hash + '-' + str(dpi) + 'dpi-q' + str(quality)
+		resampled_path = os.path.join(self.cache_folder, key + '.pdf')
+		unchanged_path = os.path.join(self.cache_folder, key + '.unchanged')
+
+		if os.path.isfile(resampled_path):
+			return resampled_path
+		if os.path.isfile(unchanged_path):
+			return content_path
+
+		# Only the leaf of os.makedirs gets the mode, so each level of the cache is created private to the user
+		os.makedirs(os.path.dirname(os.path.abspath(self.cache_folder)), mode=0o700, exist_ok=True)
+		os.makedirs(self.cache_folder, mode=0o700, exist_ok=True)
+		os.makedirs(os.path.join(self.cache_folder, 'images'), mode=0o700, exist_ok=True)
+		if self.resample(content_path, resampled_path, dpi, quality):
+			return resampled_path
+
+		# Contents without images to resample are remembered, so that they are not opened again
+		open(unchanged_path, 'w').close()
+		return content_path
+
+	def resample(self, content_path, resampled_path, dpi, quality):
+		# Write the content pdf with its images resampled, and return whether any image was
+		with pikepdf.open(content_path) as pdf:
+			sizes = {}
+			for page in pdf.pages:
+				drawn_sizes(page, page.obj.get('/Resources'), IDENTITY, sizes)
+
+			resampled = 0
+			for objgen, (width, height) in sorted(sizes.items()):
+				image = pdf.get_object(objgen)
+				scale = max(width / 72 * dpi / int(image.Width), height / 72 * dpi / int(image.Height))
+				if scale < MIN_SCALE and self.resample_image(image, scale, quality):
+					resampled += 1
+
+			if resampled == 0:
+				return False
+
+			temp_path = resampled_path + '.' + str(os.getpid()) + '.tmp'
+			pdf.save(temp_path, deterministic_id=True)
+
+		# Rewriting the pdf can cost more than small images save
+		if os.path.getsize(temp_path) >= os.path.getsize(content_path):
+			os.remove(temp_path)
+			return False
+		os.replace(temp_path, resampled_path)
+
+		logging.info('Resampled ' + str(resampled) + ' image(s) of ' + content_path + ' to ' + str(dpi) + ' dpi: ' +
+					 str(os.path.getsize(content_path)) + ' bytes before, ' + str(os.path.getsize(resampled_path)) + ' bytes after')
+		return True
+
+	def resample_image(self, image, scale, quality):
+		# Replace the data of an image xobject with a resampled copy, and return whether it was replaced
+		if image.get('/ImageMask', False) or '/Decode' in image or '/Mask' in image:
+			return False
+
+		size = (max(1, int(round(int(image.Width) * scale))), max(1, int(round(int(image.Height) * scale))))
+		filters = image.get('/Filter')
+		jpeg = filters == '/DCTDecode' or (isinstance(filters, pikepdf.Array) and '/DCTDecode' in list(filters))
+
+		image_key = hashlib.sha1(image.read_raw_bytes())
+		if '/SMask' in image:
+			image_key.update(image.SMask.read_raw_bytes())
+		cache_base = os.path.join(self.cache_folder, 'images', image_key.hexdigest() + '-' + str(size[0]) + 'x' + str(size[1]) + '-q' + str(quality))
+
+		resampled = self.load_cached(cache_base)
+		if resampled is False:
+			resampled = self.resampled_data(image, size, jpeg, quality)
+			self.save_cached(cache_base, resampled)
+
+		if resampled is None:
+			return False
+
+		# Tiny images, like the shading of table cells, can grow when recompressed
+		image_filter, image_data, mask_data = resampled
+		old_size = len(image.read_raw_bytes()) + (len(image.SMask.read_raw_bytes()) if '/SMask' in image else 0)
+		if len(image_data) + len(mask_data or b'') >= old_size:
+			return False
+
+		self.replace_data(image, size, image_filter, image_data)
+		if mask_data is not None:
+			self.replace_data(image.SMask, size, '/FlateDecode', mask_data)
+		return True
+
+	def load_cached(self, cache_base):
+		# Return the cached (filter, data, soft mask data) of an image, None if it cannot be resampled, or False if it is not cached
+		try:
+			with open(cache_base + '.json', 'r') as file_descriptor:
+				entry = json.load(file_descriptor)
+			if not entry.get('resampled'):
+				return None
+			if entry.get('filter') not in IMAGE_FILTERS:
+				return False
+
+			with open(cache_base + '.image', 'rb') as file_descriptor:
+				image_data = file_descriptor.read()
+			mask_data = None
+			if entry.get('mask'):
+				with open(cache_base + '.mask', 'rb') as file_descriptor:
+					mask_data = file_descriptor.read()
+		except (OSError, ValueError, AttributeError):
+			return False
+
+		return (entry['filter'], image_data, mask_data)
+
+	def save_cached(self, cache_base, resampled):
+		# The data is written first and the json last, so that a cached image is complete when its json is there
+		suffix = '.' + str(os.getpid()) + '.tmp'
+		entry = {'resampled': resampled is not None}
+		if resampled is not None:
+			image_filter, image_data, mask_data = resampled
+			entry.update({'filter': image_filter, 'mask': mask_data is not None})
+			for extension, data in (('.image', image_data), ('.mask', mask_data)):
+				if data is not None:
+					with open(cache_base + extension + suffix, 'wb') as file_descriptor:
+						file_descriptor.write(data)
+					os.replace(cache_base + extension + suffix, cache_base + extension)
+
+		with open(cache_base + '.json' + suffix, 'w') as file_descriptor:
+			json.dump(entry, file_descriptor)
+		os.replace(cache_base + '.json' + suffix, cache_base + '.json')
+
+	def resampled_data(self, image, size, jpeg, quality):
+		# Return (filter, data, soft mask data) of the resampled image, or None if it cannot be resampled
+		try:
+			# The soft mask is resampled on its own, and stays a soft mask
+			pil_image = pikepdf.PdfImage(image).as_pil_image(apply_mask=False)
+			pil_mask = pikepdf.PdfImage(image.SMask).as_pil_image() if '/SMask' in image else None
+		except Exception:
+			# Images that pikepdf cannot decode are left as they are
+			return None
+
+		if pil_image.mode not in ('RGB', 'L') or (pil_mask is not None and pil_mask.mode != 'L'):
+			return None
+
+		pil_image = pil_image.resize(size, Image.LANCZOS)
+		if jpeg:
+			buffer = io.BytesIO()
+			pil_image.save(buffer, 'JPEG', quality=quality, optimize=True)
+			image_filter, image_data = '/DCTDecode', buffer.getvalue()
+		else:
+			image_filter, image_data = '/FlateDecode', zlib.compress(pil_image.tobytes(), 9)
+
+		mask_data = None
+		if pil_mask is not None:
+			mask_data = zlib.compress(pil_mask.resize(size, Image.LANCZOS).tobytes(), 9)
+
+		return (image_filter, image_data, mask_data)
+
+	def replace_data(self, image, size, image_filter, image_data):
+		image.write(image_data, filter=pikepdf.Name(image_filter))
+		image.Width = size[0]
+		image.Height = size[1]
+		image.BitsPerComponent = 8
+		if '/DecodeParms' in image:
+			del image['/DecodeParms']
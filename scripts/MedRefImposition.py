@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+# Imposition of medical reference cards on printed sheets
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Frame layouts with output 'double-sided' are imposed on sheets, as set in an optional imposition section:
+#
+#   imposition:
+#     sheet: 'SRA3'          # A4, A3, SRA3 or [width, height] in cm
+#     margin: 1.0            # cm kept free along the sheet edges
+#     bleed: 0.0             # cm kept free around each card
+#     duplex: 'long-edge'    # edge the sheet is turned over: long-edge or short-edge
+#     spreads: false         # front and back side by side on one single sided sheet
+#     cut_marks: true
+#     guides: false          # thin white lines between neighbouring cards
+#
+# The densest grid of cards is used, with the sheet upright or turned. Print with the same duplex
+# setting as the frame layout, so that the backs end up behind their fronts. Where the sheet is turned
+# over its top edge (short-edge on upright sheets, long-edge on turned sheets), the backs are also
+# turned half a turn in their cells, so that they are upright when a cut card is turned over its side.
+# Without an imposition section, four cards are placed on a sheet twice the size of a card.
+
+import math
+
+from reportlab.lib.units import cm
+
+SHEET_SIZES = {
+	'A4': (21.0, 29.7),
+	'A3': (29.7, 42.0),
+	'SRA3': (32.0, 45.0)
+}
+
+DUPLEX_MODES = ('long-edge', 'short-edge')
+
+CUT_MARK_LENGTH = 0.5*cm
+CUT_MARK_OFFSET = 0.1*cm
+GUIDE_WIDTH = 0.01*cm
+
+
+# Return the imposition section of a frame layout, with defaults filled in
+def imposition_settings(frame_layout):
+	if 'imposition' not in frame_layout:
+		settings = {
+			'sheet': [2 * frame_layout['card']['width'], 2 * frame_layout['card']['height']],
+			'margin': 0,
+			'bleed': 0,
+			'cut_marks': False,
+			'guides': True
+		}
+	else:
+		settings = {
+			'sheet': 'A4',
+			'margin': 1.0,
+			'bleed': 0,
+			'cut_marks': True,
+			'guides': False
+		}
+		settings.update(frame_layout['imposition'] or {})
+
+	settings.setdefault('duplex', 'long-edge')
+	settings.setdefault('spreads', False)
+	return settings
+
+
+class MedRefImposition():
+	"""Grid of cards on a sheet, and where each card goes on the front and on the back, in points"""
+	def __init__(self, frame_layout):
+		settings = imposition_settings(frame_layout)
+		self.settings = settings
+
+		if isinstance(settings['sheet'], str):
+			if settings['sheet'].upper() not in SHEET_SIZES:
+				raise ValueError('Unknown sheet: ' + settings['sheet'] + ', use one of: ' + ', '.join(sorted(SHEET_SIZES)) + ' or [width, height]')
+			sheet = SHEET_SIZES[settings['sheet'].upper()]
+		else:
+			sheet = (float(settings['sheet'][0]), float(settings['sheet'][1]))
+
+		if settings['duplex'] not in DUPLEX_MODES:
+			raise ValueError('Unknown duplex: ' + str(settings['duplex']) + ', use one of: ' + ', '.join(DUPLEX_MODES))
+
+		self.card_width = frame_layout['card']['width']*cm
+		self.card_height = frame_layout['card']['height']*cm
+		self.spreads = bool(settings['spreads'])
+		self.margin = settings['margin']*cm
+		self.bleed = settings['bleed']*cm
+		self.cut_marks = bool(settings['cut_marks'])
+		self.guides = bool(settings['guides'])
+
+		# A spread is imposed as one unit, the back face right of the front face
+		self.cell_width = (2 if self.spreads else 1) * self.card_width + 2 * self.bleed
+		self.cell_height = self.card_height + 2 * self.bleed
+
+		# Densest grid, with the sheet as given or turned
+		best = None
+		for width, height in ((sheet[0]*cm, sheet[1]*cm), (sheet[1]*cm, sheet[0]*cm)):
+			columns = self.fit(width, self.cell_width)
+			rows = self.fit(height, self.cell_height)
+			if best is None or columns * rows > best[2] * best[3]:
+				best = (width, height, columns, rows)
+		self.sheet_width, self.sheet_height, self.columns, self.rows = best
+
+		self.cards_per_sheet = self.columns * self.rows
+		if self.cards_per_sheet == 0:
+			raise ValueError('Cards do not fit on the sheet: ' + str(settings['sheet']) + ' with a margin of ' + str(settings['margin']) + ' cm')
+
+		self.pages_per_sheet = 1 if self.spreads else 2
+
+		# Turning the sheet over an edge mirrors the grid across that edge: over a side edge the columns,
+		# over the top edge the rows, and then every back would be upside down behind its front
+		portrait = self.sheet_height >= self.sheet_width
+		self.mirror_columns = (settings['duplex'] == 'long-edge') == portrait
+		self.rotate_backs = not self.spreads and not self.mirror_columns
+
+		# Grid centred on the sheet
+		self.grid_x = (self.sheet_width - self.columns * self.cell_width) / 2
+		self.grid_y = (self.sheet_height - self.rows * self.cell_height) / 2
+
+	def __repr__(self):
+		return repr((self.settings, self.columns, self.rows))
+
+	def fit(self, length, cell_length):
+		# Rounding errors in cm to point conversions must not cost a card
+		return max(0, int(math.floor((length - 2 * self.margin) / cell_length + 1e-9)))
+
+	def sheet_size(self):
+		return (self.sheet_width, self.sheet_height)
+
+	def positions(self, face_nr):
+		# Return the lower left corner of each card on the front (1) or back (2) of a sheet, left to right and top to bottom
+		positions = []
+		for slot in range(self.cards_per_sheet):
+			column = slot % self.columns
+			row = slot // self.columns
+
+			if face_nr == 2 and not self.spreads:
+				if self.mirror_columns:
+					column = self.columns - 1 - column
+				else:
+					row = self.rows - 1 - row
+
+			positions.append((self.grid_x + column * self.cell_width + self.bleed,
+							  self.grid_y + (self.rows - 1 - row) * self.cell_height + self.bleed))
+		return positions
+
+	def draw_marks(self, c, face_nr):
+		if self.guides:
+			self.draw_guides(c)
+		if self.cut_marks and face_nr == 1:
+			self.draw_cut_marks(c)
+
+	def draw_guides(self, c):
+		c.setFillColorRGB(1, 1, 1)
+
+		for column in range(1, self.columns):
+			c.rect(	self.grid_x + column * self.cell_width - GUIDE_WIDTH/2, self.grid_y,
+					GUIDE_WIDTH, self.rows * self.cell_height,
+					stroke=0, fill=1)
+
+		for row in range(1, self.rows):
+			c.rect(	self.grid_x, self.grid_y + row * self.cell_height - GUIDE_WIDTH/2,
+					self.columns * self.cell_width, GUIDE_WIDTH,
+					stroke=0, fill=1)
+
+	def draw_cut_marks(self, c):
+		# Marks in the margin, in line with the edges of every card
+		length = min(CUT_MARK_LENGTH, self.margin - CUT_MARK_OFFSET)
+		if length <= 0:
+			return
+
+		unit_width = self.cell_width - 2 * self.bleed
+		xs = set()
+		for column in range(self.columns):
+			x = self.grid_x + column * self.cell_width + self.bleed
+			xs.update((round(x, 3), round(x + unit_width, 3)))
+		ys = set()
+		for row in range(self.rows):
+			y = self.grid_y + row * self.cell_height + self.bleed
+			ys.update((round(y, 3), round(y + self.card_height, 3)))
+
+		bottom = self.grid_y - CUT_MARK_OFFSET
+		top = self.grid_y + self.rows * self.cell_height + CUT_MARK_OFFSET
+		left = self.grid_x - CUT_MARK_OFFSET
+		right = self.grid_x + self.columns * self.cell_width + CUT_MARK_OFFSET
+
+		c.saveState()
+		c.setStrokeColorRGB(0, 0, 0)
+		c.setLineWidth(0.25)
+		for x in sorted(xs):
+			c.line(x, bottom - length, x, bottom)
+			c.line(x, top, x, top + length)
+		for y in sorted(ys):
+			c.line(left - length, y, left, y)
+			c.line(right, y, right + length, y)
+		c.restoreState()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Profiling of the builds of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Kept apart from the rendering, so that the card descriptions can be loaded without importing reportlab and pdfrw
+
+import os, time, functools, tracemalloc, resource
+
+
+# Return the current resident set size of the process in bytes, or the largest so far where it cannot be read
+def resident_memory():
+	try:
+		with open('/proc/self/statm', 'r') as file_descriptor:
+			return int(file_descriptor.read().split()[1]) * resource.getpagesize()
+	except (OSError, ValueError, IndexError):
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Timings taken while tracing memory are not comparable to those of a normal build
+def without_seconds(entry):
+	return dict((key, value) for key, value in entry.items() if key != 'seconds')
+
+
+class MedRefProfiler():
+	"""Wall time, number of calls and peak memory per build stage"""
+	def __init__(self):
+		self.enabled = False
+		self.trace_memory = False
+		self.reset()
+
+	def reset(self):
+		self.stages = {}
+		self.counts = {}
+		self.outputs = []
+		self.stack = []
+
+	def __repr__(self):
+		return repr((self.enabled, self.stages, self.outputs))
+
+	def start(self, trace_memory=False):
+		# Memory is the resident set size of the process, unless python allocations are traced, which is
+		# more precise per stage but slows everything down, so the timings are then left out of the report
+		self.enabled = True
+		self.trace_memory = trace_memory
+		if trace_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+	def stage(self, name):
+		return _ProfilerStage(self, name) if self.enabled else _no_stage
+
+	def memory(self):
+		if self.trace_memory:
+			return tracemalloc.get_traced_memory()[1]
+		return resident_memory()
+
+	def enter(self, name):
+		# The peak reached so far belongs to the enclosing stage, before the peak is reset for this one
+		peak = self.memory()
+		if len(self.stack) > 0:
+			self.stack[-1][2] = max(self.stack[-1][2], peak)
+		if self.trace_memory:
+			tracemalloc.reset_peak()
+			peak = 0
+		# The clock starts after, and stops before, the memory is measured
+		self.stack.append([name, time.perf_counter(), peak])
+
+	def exit(self):
+		seconds = time.perf_counter() - self.stack[-1][1]
+		name, start_time, peak = self.stack.pop()
+		peak = max(peak, self.memory())
+		if len(self.stack) > 0:
+			self.stack[-1][2] = max(self.stack[-1][2], peak)
+		self.add(name, 1, seconds, peak)
+
+	def add(self, name, calls, seconds, peak_memory):
+		stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_memory': 0})
+		stage['calls'] += calls
+		stage['seconds'] += seconds
+		stage['peak_memory'] = max(stage['peak_memory'], peak_memory)
+
+	def count(self, name, number=1):
+		if self.enabled:
+			self.counts[name] = self.counts.get(name, 0) + number
+
+	def add_output(self, output_path, seconds):
+		self.outputs.append({'path': output_path, 'bytes': os.path.getsize(output_path), 'seconds': seconds})
+
+	def merge(self, report):
+		# Include the report of another process, e.g. a build worker
+		for name, stage in report['stages'].items():
+			self.add(name, stage['calls'], stage.get('seconds', 0.0), stage['peak_memory'])
+		for name, number in report['counts'].items():
+			self.count(name, number)
+		self.outputs.extend(report['outputs'])
+
+	def report(self):
+		stages, outputs = self.stages, self.outputs
+		if self.trace_memory:
+			stages = dict((name, without_seconds(stage)) for name, stage in stages.items())
+			outputs = [without_seconds(output) for output in outputs]
+
+		return {
+			'stages': stages,
+			'counts': self.counts,
+			'outputs': outputs,
+			'memory': 'tracemalloc' if self.trace_memory else 'rss',
+			'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		}
+
+
+class _ProfilerStage():
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.profiler.enter(self.name)
+
+	def __exit__(self, *exc_info):
+		self.profiler.exit()
+
+
+class _NoStage():
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *exc_info):
+		pass
+
+_no_stage = _NoStage()
+
+# Profiler shared by the whole build, started by the command line with --profile
+profiler = MedRefProfiler()
+
+# Decorator recording each call of a function as a profiler stage
+def profiled(function):
+	@functools.wraps(function)
+	def wrapper(*args, **kwargs):
+		with profiler.stage(function.__name__):
+			return function(*args, **kwargs)
+	return wrapper
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+# Full-text search index for the decks of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Each pdf gets a <name>.index.json next to it, that a viewer can load instead of the pdf:
+#
+#   {"version": 1, "pdf": "<name>.pdf",
+#    "cards": [{"id": ..., "domain": ..., "category": ..., "front_header": ..., "back_header": ...,
+#               "front_pages": [2], "back_pages": [3]}, ...],
+#    "terms": {"<term>": [<face>, ...], ...}}
+#
+# A face is 2 * card number for the front of a card, and 2 * card number + 1 for the back, so that
+# a term leads to the card faces and their pages, also where several cards share a page.
+# Pages are numbered from 1, as in the pdf. Terms come from the headers, toc entries, references,
+# domain and category of each card, and from the text of its content pdf:s when pymupdf is installed.
+# A query matches the faces that have every word of it, the last word also as the start of a term.
+
+import os, re, json, bisect, logging
+
+# Optionally uses pymupdf to extract the text of the content pdf:s. It is slow to import, so it is
+# imported when the first index is built, and queries do without it
+_pymupdf = []
+
+def import_pymupdf():
+	if len(_pymupdf) == 0:
+		try:
+			import pymupdf
+		except ImportError:
+			pymupdf = None
+		_pymupdf.append(pymupdf)
+	return _pymupdf[0]
+
+TERM_REG_EX = re.compile(r'\w+')
+
+# Extracted text of content pdf:s, by path and (modification time, size)
+_content_texts = {}
+
+
+def terms(text):
+	return set(term for term in TERM_REG_EX.findall(str(text).lower()) if len(term) > 1 or term.isdigit())
+
+
+def content_text(content_path):
+	pymupdf = import_pymupdf()
+	if pymupdf is None or not os.path.isfile(content_path):
+		return ''
+
+	stat = os.stat(content_path)
+	signature = (stat.st_mtime_ns, stat.st_size)
+	if content_path in _content_texts and _content_texts[content_path][0] == signature:
+		return _content_texts[content_path][1]
+
+	with pymupdf.open(content_path) as document:
+		text = document[0].get_text() if len(document) > 0 else ''
+	_content_texts[content_path] = (signature, text)
+	return text
+
+
+class MedRefSearchIndex():
+	"""Inverted index from terms to the card faces and pages of a deck pdf"""
+	version = 1
+
+	def __init__(self, pdf_name='', cards=None, terms=None):
+		self.pdf_name = pdf_name
+		self.cards = cards or []
+		self.terms = terms or {}
+		self.sorted_terms = sorted(self.terms)
+
+	def __repr__(self):
+		return repr((self.pdf_name, len(self.cards), len(self.terms)))
+
+	@classmethod
+	def build(cls, pdf_name, cards, face_pages):
+		"""Index the cards of a pdf, with the pages each card face was drawn on"""
+		index_cards = []
+		index_terms = {}
+
+		for card_nr, card in enumerate(cards):
+			index_card = {
+				'id': card.card_fn,
+				'domain': card.domain,
+				'category': card.category,
+				'front_header': card.front_face.header,
+				'back_header': card.back_face.header
+			}
+
+			card_terms = terms(card.domain) | terms(card.category)
+			for side, card_face in enumerate((card.front_face, card.back_face)):
+				index_card[('front', 'back')[side] + '_pages'] = sorted(face_pages.get(id(card_face), []))
+
+				face_terms = set(card_terms)
+				for text in [card_face.header, content_text(card_face.content_path)] + list(card_face.toc or []) + list(card_face.references or []):
+					face_terms |= terms(text)
+				for term in face_terms:
+					index_terms.setdefault(term, []).append(2 * card_nr + side)
+
+			index_cards.append(index_card)
+
+		if import_pymupdf() is None:
+			logging.info('Indexed the card descriptions of ' + pdf_name + '. Install pymupdf to index the text of the content pdf:s too.')
+
+		return cls(pdf_name, index_cards, index_terms)
+
+	@classmethod
+	def load(cls, index_path):
+		with open(index_path, 'r') as file_descriptor:
+			data = json.load(file_descriptor)
+		if data.get('version') != cls.version:
+			raise ValueError('Unsupported search index version: ' + index_path)
+		return cls(data['pdf'], data['cards'], data['terms'])
+
+	def save(self, index_path):
+		temp_path = index_path + '.' + str(os.getpid()) + '.tmp'
+		with open(temp_path, 'w') as file_descriptor:
+			json.dump({'version': self.version, 'pdf': self.pdf_name, 'cards': self.cards, 'terms': self.terms},
+					  file_descriptor, separators=(',', ':'), ensure_ascii=False, sort_keys=True)
+		os.replace(temp_path, index_path)
+
+	def prefix_faces(self, prefix):
+		# Faces of every term that starts with prefix, found by bisection over the sorted terms
+		faces = set()
+		position = bisect.bisect_left(self.sorted_terms, prefix)
+		while position < len(self.sorted_terms) and self.sorted_terms[position].startswith(prefix):
+			faces.update(self.terms[self.sorted_terms[position]])
+			position += 1
+		return faces
+
+	def query(self, text):
+		"""Return (page, card, side) for the card faces that match every word of text, in page order"""
+		words = TERM_REG_EX.findall(str(text).lower())
+		if len(words) == 0:
+			return []
+
+		faces = None
+		for word_nr, word in enumerate(words):
+			if word_nr == len(words) - 1:
+				word_faces = self.prefix_faces(word)
+			else:
+				word_faces = set(self.terms.get(word, []))
+			faces = word_faces if faces is None else faces & word_faces
+			if len(faces) == 0:
+				return []
+
+		results = []
+		for face in faces:
+			card = self.cards[face // 2]
+			side = ('front', 'back')[face % 2]
+			for page in card[side + '_pages']:
+				results.append((page, card, side))
+		return sorted(results, key=lambda result: (result[0], result[2]))
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+# Local render service for custom decks of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# The service answers two requests:
+#
+#   GET  /cards    the cards that can be picked, by localisation (json)
+#   POST /render   a pdf with the picked cards, for a request like
+#                  {"cards": ["medicine-af-chadsvas", "neurology-examination-gcs"],
+#                   "frame_layout": "screen", "colour_scheme": "default-colour-scheme",
+#                   "localisation": "eng", "no_title": false}
+#
+# Decks are loaded once, when the service starts, and rendering is done by a pool of worker
+# processes that keep their imported card contents and pre-rendered card faces between requests.
+# Identical requests are answered from a cache, for as long as the files they use are unchanged.
+# Restart the service to pick up added or removed cards.
+
+import os, json, hashlib, logging, threading, tempfile, shutil, uuid, collections, concurrent.futures
+import http.server
+
+import MedRefCards, MedRefDeck
+
+CHUNK_SIZE = 64 * 1024
+
+
+# Decks and render folder of a worker process
+_render_med_ref_cards = {}
+_render_folder = []
+
+def _init_render_worker(med_ref_cards_by_localisation, render_folder):
+	_render_med_ref_cards.update(med_ref_cards_by_localisation)
+	_render_folder.append(render_folder)
+
+	# Contents that cannot be read are skipped while warming, and only fail the requests that draw them
+	MedRefCards.profiler.reset()
+	for med_ref_cards in _render_med_ref_cards.values():
+		med_ref_cards.content_cache.read_only = True
+		med_ref_cards.warm_content_cache()
+
+def _render_worker(localisation, card_ids, frame_layout, colour_scheme, no_title):
+	file_name = 'render-' + uuid.uuid4().hex
+	output_path = _render_med_ref_cards[localisation].generate_pdf(colour_scheme, frame_layout, _render_folder[0], file_name,
+																	no_title=no_title, force=True, card_ids=card_ids, no_manifest=True)
+	try:
+		with open(output_path, 'rb') as file_descriptor:
+			return file_descriptor.read()
+	finally:
+		os.remove(output_path)
+
+
+class MedRefRenderService():
+	"""Renders custom decks on request, with warm decks and caches in a pool of worker processes"""
+	def __init__(self, med_ref_cards_list, jobs=None, result_cache_size=64):
+		self.med_ref_cards_by_localisation = dict((med_ref_cards.med_ref_deck.localisation, med_ref_cards) for med_ref_cards in med_ref_cards_list)
+		self.result_cache_size = result_cache_size
+		self.results = collections.OrderedDict()
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.render_folder = tempfile.mkdtemp(prefix='medical-reference-cards-render-')
+
+		for med_ref_cards in med_ref_cards_list:
+			os.makedirs(os.path.join(self.render_folder, med_ref_cards.med_ref_deck.localisation))
+
+			# Card faces are shared by all custom decks, so they are only drawn once
+			if med_ref_cards.fragment_folder is None:
+				med_ref_cards.fragment_folder = os.path.join(self.render_folder, 'fragments')
+				os.makedirs(med_ref_cards.fragment_folder, exist_ok=True)
+
+		self.jobs = jobs
+		self.executor = self.start_executor()
+
+	def start_executor(self):
+		return concurrent.futures.ProcessPoolExecutor(self.jobs, initializer=_init_render_worker,
+													  initargs=(self.med_ref_cards_by_localisation, self.render_folder))
+
+	def __repr__(self):
+		return repr((sorted(self.med_ref_cards_by_localisation.keys()), self.render_folder, len(self.results)))
+
+	def shutdown(self):
+		self.executor.shutdown()
+		shutil.rmtree(self.render_folder, ignore_errors=True)
+
+	def card_list(self):
+		cards = {}
+		for localisation, med_ref_cards in self.med_ref_cards_by_localisation.items():
+			cards[localisation] = [{
+				'id': card.card_fn,
+				'domain': card.domain,
+				'category': card.category,
+				'front_header': card.front_face.header,
+				'back_header': card.back_face.header
+			} for card in med_ref_cards.med_ref_deck.cards]
+		return cards
+
+	def parse_request(self, request):
+		# Return the render arguments of a request, or raise ValueError
+		if not isinstance(request, dict):
+			raise ValueError('The request must be a json object')
+
+		localisation = request.get('localisation', 'eng')
+		if not isinstance(localisation, str) or localisation not in self.med_ref_cards_by_localisation:
+			raise ValueError('Unknown localisation: ' + str(localisation))
+		med_ref_cards = self.med_ref_cards_by_localisation[localisation]
+
+		card_ids = request.get('cards')
+		if not isinstance(card_ids, list) or len(card_ids) == 0:
+			raise ValueError('The request must list the cards to render')
+		if not all(isinstance(card_id, str) for card_id in card_ids):
+			raise ValueError('The cards must be listed by their ids, as strings')
+		unknown_cards = [str(card_id) for card_id in card_ids if card_id not in med_ref_cards.med_ref_deck.card_positions]
+		if len(unknown_cards) > 0:
+			raise ValueError('Unknown cards: ' + ', '.join(unknown_cards))
+
+		frame_layout = request.get('frame_layout', 'screen')
+		colour_scheme = request.get('colour_scheme', 'default-colour-scheme')
+		# Only names of the theme files themselves, never paths, are accepted
+		for theme_folder, name in (('frame-layouts', frame_layout), ('colour-schemes', colour_scheme)):
+			if name not in MedRefDeck.list_theme_files(med_ref_cards.theme_path, theme_folder):
+				raise ValueError('Unknown ' + theme_folder[:-1].replace('-', ' ') + ': ' + str(name))
+
+		return (localisation, card_ids, frame_layout, colour_scheme, bool(request.get('no_title', False)))
+
+	def request_key(self, render_args):
+		# Identical requests share a key, for as long as the files they use are unchanged
+		localisation, card_ids, frame_layout, colour_scheme, no_title = render_args
+		med_ref_cards = self.med_ref_cards_by_localisation[localisation]
+
+		key = hashlib.sha1(json.dumps(render_args).encode('utf-8'))
+		input_files = [os.path.join(med_ref_cards.theme_path, 'frame-layouts', frame_layout + '.yml'),
+					   os.path.join(med_ref_cards.theme_path, 'colour-schemes', colour_scheme + '.yml')]
+		for card_id in card_ids:
+			card = med_ref_cards.med_ref_deck.cards[med_ref_cards.med_ref_deck.card_positions[card_id]]
+			input_files.extend([card.card_file, card.front_face.content_path, card.back_face.content_path])
+		for input_file in input_files:
+			key.update(str(MedRefCards.file_hash(input_file)).encode('utf-8'))
+		return key.hexdigest()
+
+	def render(self, render_args):
+		# Return the pdf for the render arguments of a request, and whether it came from the result cache
+		key = self.request_key(render_args)
+
+		with self.lock:
+			if key in self.results:
+				self.results.move_to_end(key)
+				return self.results[key], True
+
+			# Identical requests that arrive together wait for the same render
+			future = self.pending.get(key)
+			if future is None:
+				future = self.pending[key] = self.executor.submit(_render_worker, *render_args)
+			executor = self.executor
+
+		try:
+			pdf = future.result()
+		except concurrent.futures.BrokenExecutor:
+			# A worker that died takes the pool with it, so the requests after this one get a new pool
+			with self.lock:
+				if self.executor is executor:
+					logging.error('Render worker died, starting new render workers')
+					self.executor = self.start_executor()
+			executor.shutdown(wait=False)
+			raise
+		finally:
+			with self.lock:
+				self.pending.pop(key, None)
+
+		with self.lock:
+			self.results[key] = pdf
+			while len(self.results) > self.result_cache_size:
+				self.results.popitem(last=False)
+
+		return pdf, False
+
+
+class MedRefRequestHandler(http.server.BaseHTTPRequestHandler):
+	"""HTTP requests to the render service"""
+	server_version = 'MedRefCards'
+
+	def do_GET(self):
+		if self.path.rstrip('/') == '/cards':
+			self.send_json(200, self.server.service.card_list())
+		else:
+			self.send_json(404, {'error': 'Not found: ' + self.path})
+
+	def do_POST(self):
+		if self.path.rstrip('/') != '/render':
+			self.send_json(404, {'error': 'Not found: ' + self.path})
+			return
+
+		# Only a request that cannot be read or names what is not there is the client's error
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+			request = json.loads(self.rfile.read(length).decode('utf-8'))
+			render_args = self.server.service.parse_request(request)
+		except ValueError as error:
+			self.send_json(400, {'error': str(error)})
+			return
+
+		try:
+			pdf, cached = self.server.service.render(render_args)
+		except Exception:
+			logging.exception('Render failed')
+			self.send_json(500, {'error': 'Render failed'})
+			return
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/pdf')
+		self.send_header('Content-Length', str(len(pdf)))
+		self.send_header('X-Result-Cache', 'hit' if cached else 'miss')
+		self.end_headers()
+		for start in range(0, len(pdf), CHUNK_SIZE):
+			self.wfile.write(pdf[start:start + CHUNK_SIZE])
+
+	def send_json(self, status, data):
+		body = json.dumps(data).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logging.info('%s - %s' % (self.address_string(), format % args))
+
+
+def serve(med_ref_cards_list, host='127.0.0.1', port=8080, jobs=None):
+	service = MedRefRenderService(med_ref_cards_list, jobs)
+	server = http.server.ThreadingHTTPServer((host, port), MedRefRequestHandler)
+	server.service = service
+
+	print('Serving medical reference cards on http://' + host + ':' + str(server.server_address[1]) + ' (Ctrl-C to stop)')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		service.shutdown()
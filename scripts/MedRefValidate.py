@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+# Pre-flight validation of the cards and themes of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Checks everything a render depends on, without rendering:
+#
+#   card descriptions      against templates/card-description-template.yml
+#   content pdf:s          present, readable, and the size of the content area of every frame layout
+#   colour schemes         a colour for every domain
+#   frame layouts          complete, and the cards fit on the sheets of double-sided layouts
+#   outline keys           unique within a deck, or outline entries link to the wrong page
+#   .yml.INPROGRESS files  cards that are left out of the decks
+#
+# Cards are checked in a pool of worker processes. Problems are errors or warnings, and
+# validate() returns the problems found, so that the command line can fail on them.
+
+import os, re, logging, functools, concurrent.futures
+import yaml
+
+import MedRefDeck
+from MedRefImposition import MedRefImposition
+
+from pdfrw import PdfReader
+from reportlab.lib.units import cm
+
+# Content pdf:s may differ this much (in cm) from the content area of a frame layout
+MEDIA_BOX_TOLERANCE = 0.05
+
+REQUIRED_FIELDS = ('domain', 'category', 'front_header', 'back_header')
+DATE_FIELDS = ('modified_date', 'verified_date')
+DATE_REG_EX = re.compile(r'^(\d{6})?$')
+
+# Faces with this header are left blank on purpose, and need no content pdf
+EMPTY_HEADER = '- Empty -'
+
+FRAME_LAYOUT_FIELDS = ('output', 'content', 'border', 'key_ring', 'static_text')
+
+
+# Return the problems with one card description and its content pdf:s, as (severity, path, message)
+def validate_card(card_file, template, content_sizes, colour_schemes):
+	problems = []
+
+	try:
+		card_dict = MedRefDeck.yaml_loader(card_file)
+	except yaml.YAMLError as error:
+		return [('error', card_file, 'not valid yaml: ' + ' '.join(str(error).split()))]
+	if not isinstance(card_dict, dict):
+		return [('error', card_file, 'not a card description')]
+
+	for field, template_value in template.items():
+		if field not in card_dict:
+			problems.append(('error', card_file, 'missing field: ' + field))
+			continue
+
+		value = card_dict[field]
+		if isinstance(template_value, list):
+			if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+				problems.append(('error', card_file, field + ' should be a list of text'))
+		elif not isinstance(value, str):
+			problems.append(('error', card_file, field + ' should be text, quote the value: ' + repr(value)))
+
+	for field in card_dict:
+		if field not in template:
+			problems.append(('warning', card_file, 'unknown field: ' + str(field)))
+
+	for field in REQUIRED_FIELDS:
+		if isinstance(card_dict.get(field), str) and card_dict[field].strip() == '':
+			problems.append(('error', card_file, 'empty field: ' + field))
+
+	for field in DATE_FIELDS:
+		if isinstance(card_dict.get(field), str) and not DATE_REG_EX.match(card_dict[field]):
+			problems.append(('warning', card_file, field + ' should be YYMMDD: ' + card_dict[field]))
+
+	domain = card_dict.get('domain')
+	if isinstance(domain, str) and domain.strip() != '':
+		for colour_scheme, domains in sorted(colour_schemes.items()):
+			if domain.lower() not in domains:
+				problems.append(('error', card_file, 'no colour for domain ' + repr(domain.lower()) + ' in colour scheme: ' + colour_scheme))
+
+	card_base = card_file[:-len('.yml')]
+	for side in ('front', 'back'):
+		content_path = card_base + '-' + side + '.pdf'
+		if card_dict.get(side + '_header') == EMPTY_HEADER and not os.path.isfile(content_path):
+			continue
+		problems.extend(validate_content(content_path, content_sizes))
+
+	return problems
+
+
+def validate_content(content_path, content_sizes):
+	if not os.path.isfile(content_path):
+		return [('error', content_path, 'missing content pdf')]
+
+	try:
+		pages = PdfReader(content_path).pages
+		media_box = [float(value) for value in pages[0].inheritable.MediaBox]
+	except Exception as error:
+		return [('error', content_path, 'not a readable pdf: ' + str(error))]
+
+	problems = []
+	if len(pages) > 1:
+		problems.append(('warning', content_path, str(len(pages)) + ' pages, only the first one is drawn'))
+
+	width = (media_box[2] - media_box[0]) / cm
+	height = (media_box[3] - media_box[1]) / cm
+	mismatched = [frame_layout for frame_layout, (content_width, content_height) in sorted(content_sizes.items())
+				  if abs(width - content_width) > MEDIA_BOX_TOLERANCE or abs(height - content_height) > MEDIA_BOX_TOLERANCE]
+	if len(mismatched) > 0:
+		problems.append(('error', content_path, 'page is {:.2f} x {:.2f} cm, not the content area of: {}'.format(width, height, ', '.join(mismatched))))
+
+	return problems
+
+
+# Return the outline keys that draw_card_spread and draw_card_page bookmark for a card
+def outline_keys(card_dict, output):
+	front_header = str(card_dict.get('front_header'))
+	back_header = str(card_dict.get('back_header'))
+	front_toc = [title for title in (card_dict.get('front_toc') or []) if title != '']
+	back_toc = [title for title in (card_dict.get('back_toc') or []) if title != '']
+
+	keys = [front_header + '-' + back_header]
+	if output == 'spread':
+		keys += [front_header + '-front', back_header + '-back']
+		keys += [front_header + '-' + str(item_nr) for item_nr in range(len(front_toc))]
+		keys += [back_header + '-' + str(item_nr) for item_nr in range(len(front_toc), len(front_toc) + len(back_toc))]
+	else:
+		keys += [front_header, back_header]
+		keys += [front_header + '-' + str(item_nr) for item_nr in range(len(front_toc))]
+		keys += [back_header + '-' + str(item_nr) for item_nr in range(len(back_toc))]
+	return keys
+
+
+def validate_deck(content_path, card_files, in_progress_files, frame_layouts):
+	problems = []
+
+	for in_progress_file in in_progress_files:
+		problems.append(('warning', in_progress_file, 'in progress, left out of the deck'))
+
+	card_dicts = {}
+	card_fns = {}
+	for card_file in card_files:
+		card_fn = os.path.basename(card_file)[:-len('.yml')]
+		if card_fn in card_fns:
+			problems.append(('error', card_file, 'same card name as ' + card_fns[card_fn]))
+		card_fns[card_fn] = card_file
+
+		try:
+			card_dict = MedRefDeck.yaml_loader(card_file)
+		except yaml.YAMLError:
+			continue
+		if isinstance(card_dict, dict):
+			card_dicts[card_file] = card_dict
+
+	# Outline keys are bookmarks, so a repeated key makes earlier entries link to the last page bookmarked with it
+	outputs = sorted(set(frame_layout['output'] for frame_layout in frame_layouts.values()) - set(['double-sided']))
+	for output in outputs:
+		seen = {}
+		for card_file, card_dict in card_dicts.items():
+			for key in outline_keys(card_dict, output):
+				if key in seen and seen[key] != card_file:
+					problems.append(('warning', card_file, 'outline key ' + repr(key) + ' also used by ' + seen[key] + ' (' + output + ' output)'))
+				elif key in seen:
+					problems.append(('warning', card_file, 'outline key ' + repr(key) + ' used twice (' + output + ' output)'))
+				seen.setdefault(key, card_file)
+
+	return problems
+
+
+def validate_theme(theme_path):
+	# Return the problems with the frame layouts and colour schemes, the frame layouts, and the domains of each colour scheme
+	problems = []
+	frame_layouts = {}
+	colour_schemes = {}
+
+	for frame_layout_name in MedRefDeck.list_frame_layouts(theme_path):
+		frame_layout_path = os.path.join(theme_path, 'frame-layouts', frame_layout_name + '.yml')
+		try:
+			frame_layout = MedRefDeck.yaml_loader(frame_layout_path)
+			missing = [field for field in FRAME_LAYOUT_FIELDS if field not in frame_layout]
+			if len(missing) > 0:
+				problems.append(('error', frame_layout_path, 'missing fields: ' + ', '.join(missing)))
+				continue
+			MedRefDeck.set_frame_layout(frame_layout)
+			if frame_layout['output'] == 'double-sided':
+				MedRefImposition(frame_layout)
+		except (yaml.YAMLError, KeyError, TypeError, ValueError) as error:
+			problems.append(('error', frame_layout_path, ' '.join(str(error).split())))
+			continue
+		frame_layouts[frame_layout_name] = frame_layout
+
+	colour_scheme_folder = os.path.join(theme_path, 'colour-schemes')
+	for name in sorted(os.listdir(colour_scheme_folder)):
+		if not name.endswith('.yml'):
+			continue
+		colour_scheme_path = os.path.join(colour_scheme_folder, name)
+		try:
+			colour_scheme = MedRefDeck.yaml_loader(colour_scheme_path)
+		except yaml.YAMLError as error:
+			problems.append(('error', colour_scheme_path, 'not valid yaml: ' + ' '.join(str(error).split())))
+			continue
+
+		for domain, colour in (colour_scheme or {}).items():
+			if not isinstance(colour, list) or len(colour) != 3 or not all(isinstance(value, int) and 0 <= value <= 255 for value in colour):
+				problems.append(('error', colour_scheme_path, 'colour of ' + str(domain) + ' should be [red, green, blue] in 0-255: ' + repr(colour)))
+		colour_schemes[name[:-len('.yml')]] = set(str(domain).lower() for domain in (colour_scheme or {}))
+
+	return problems, frame_layouts, colour_schemes
+
+
+def validate(localisations, content_path='../contents', theme_path='../theme', template_path='../templates/card-description-template.yml', jobs=None):
+	"""Validate the cards of each localisation and the theme, and return the problems found as (severity, path, message)"""
+	problems, frame_layouts, colour_schemes = validate_theme(theme_path)
+	template = MedRefDeck.yaml_loader(template_path)
+	content_sizes = dict((name, (frame_layout['content']['width'], frame_layout['content']['height'])) for name, frame_layout in frame_layouts.items())
+
+	decks = []
+	for localisation in localisations:
+		localisation_path = os.path.join(content_path, localisation)
+		if not os.path.isdir(localisation_path):
+			problems.append(('error', localisation_path, 'no such localisation'))
+			continue
+		card_files = MedRefDeck.find_files(localisation_path, '*.yml')
+		in_progress_files = MedRefDeck.find_files(localisation_path, '*.yml.INPROGRESS')
+		decks.append((localisation_path, card_files, in_progress_files))
+
+	check_card = functools.partial(validate_card, template=template, content_sizes=content_sizes, colour_schemes=colour_schemes)
+	all_card_files = [card_file for localisation_path, card_files, in_progress_files in decks for card_file in card_files]
+
+	chunk_size = max(1, len(all_card_files) // (4 * (jobs or os.cpu_count() or 1)))
+	with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+		for card_problems in executor.map(check_card, all_card_files, chunksize=chunk_size):
+			problems.extend(card_problems)
+
+	for localisation_path, card_files, in_progress_files in decks:
+		problems.extend(validate_deck(localisation_path, card_files, in_progress_files, frame_layouts))
+
+	logging.info('Validated ' + str(len(all_card_files)) + ' cards and ' + str(len(frame_layouts)) + ' frame layouts')
+	return problems
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+# Watch mode for medical reference cards: rebuild the pdf:s affected by changed files
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# The watcher polls modification times, so it needs nothing beyond the standard library.
+# Everything that makes a rebuild fast stays in memory between rebuilds: the decks and their
+# catalogues, the parsed theme files, the imported card contents and the pre-rendered card faces.
+
+import os, time, logging, shutil, tempfile
+
+
+# Return (modification time, size) of every card and theme file below path, skipping source folders
+def snapshot(path, result=None):
+	if result is None:
+		result = {}
+	if not os.path.isdir(path):
+		return result
+
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.is_dir():
+				if entry.name != 'source':
+					snapshot(entry.path, result)
+			elif entry.name.endswith('.yml') or entry.name.endswith('.pdf'):
+				stat = entry.stat()
+				result[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+	return result
+
+
+class MedRefWatcher():
+	"""Keeps decks and caches warm, and rebuilds the outputs affected by changed files"""
+	def __init__(self, med_ref_cards_list, frame_layouts, colour_scheme='default-colour-scheme', output_folder='../pdf',
+				 optimise=False, theme_path='../theme'):
+		self.med_ref_cards_list = med_ref_cards_list
+		self.frame_layouts = frame_layouts
+		self.colour_scheme = colour_scheme
+		self.output_folder = output_folder
+		self.optimise = optimise
+		self.theme_path = theme_path
+
+		# Unchanged card faces are reused from pre-rendered fragments, in a folder of the watcher unless one was given
+		self.fragment_folder = None
+		for med_ref_cards in med_ref_cards_list:
+			if med_ref_cards.fragment_folder is None:
+				if self.fragment_folder is None:
+					self.fragment_folder = tempfile.mkdtemp(prefix='medical-reference-cards-fragments-')
+				med_ref_cards.fragment_folder = self.fragment_folder
+
+		self.watched_paths = [os.path.join(self.theme_path, 'colour-schemes'), os.path.join(self.theme_path, 'frame-layouts')]
+		for med_ref_cards in med_ref_cards_list:
+			self.watched_paths.append(med_ref_cards.med_ref_deck.content_path)
+
+		self.files = self.snapshot()
+
+	def __repr__(self):
+		return repr((self.watched_paths, self.frame_layouts, self.colour_scheme, self.output_folder))
+
+	def shutdown(self):
+		if self.fragment_folder is not None:
+			for med_ref_cards in self.med_ref_cards_list:
+				if med_ref_cards.fragment_folder == self.fragment_folder:
+					med_ref_cards.fragment_folder = None
+			shutil.rmtree(self.fragment_folder, ignore_errors=True)
+			self.fragment_folder = None
+
+	def snapshot(self):
+		files = {}
+		for path in self.watched_paths:
+			snapshot(path, files)
+		return files
+
+	def changed_files(self):
+		files = self.snapshot()
+		changed = [path for path in set(files) | set(self.files) if files.get(path) != self.files.get(path)]
+		self.files = files
+		return sorted(changed)
+
+	def affected_targets(self, changed):
+		# Return the (med_ref_cards, frame_layout) pairs to rebuild, and reload the decks whose card descriptions changed
+		colour_scheme_path = os.path.join(self.theme_path, 'colour-schemes', '')
+		frame_layout_path = os.path.join(self.theme_path, 'frame-layouts', '')
+
+		targets = []
+		for med_ref_cards in self.med_ref_cards_list:
+			content_path = os.path.join(med_ref_cards.med_ref_deck.content_path, '')
+			layouts = set()
+			reload_deck = False
+
+			for path in changed:
+				if path.startswith(colour_scheme_path):
+					if os.path.basename(path) in (self.colour_scheme + '.yml', 'default-colour-scheme.yml'):
+						layouts.update(self.frame_layouts)
+				elif path.startswith(frame_layout_path):
+					layout = os.path.basename(path)[:-len('.yml')]
+					if layout in self.frame_layouts or layout == 'default-frame-layout':
+						layouts.update([layout] if layout in self.frame_layouts else self.frame_layouts)
+				elif path.startswith(content_path):
+					layouts.update(self.frame_layouts)
+					if path.endswith('.yml'):
+						reload_deck = True
+
+			if reload_deck:
+				med_ref_cards.reload_deck()
+
+			for frame_layout in self.frame_layouts:
+				if frame_layout in layouts:
+					targets.append((med_ref_cards, frame_layout))
+
+		return targets
+
+	def build(self, targets):
+		# The build manifests make outputs that were not really affected return at once
+		for med_ref_cards, frame_layout in targets:
+			start_time = time.time()
+			output_path = med_ref_cards.generate_pdf(self.colour_scheme, frame_layout, self.output_folder, optimise=self.optimise)
+			print('{:8.2f}s  {}'.format(time.time() - start_time, output_path))
+
+	def run(self, interval=0.5):
+		# Build once, then keep rebuilding on changes until interrupted, and remove the fragments of the watcher after
+		try:
+			self.build([(med_ref_cards, frame_layout) for med_ref_cards in self.med_ref_cards_list for frame_layout in self.frame_layouts])
+			print('Watching ' + ', '.join(self.watched_paths) + ' (Ctrl-C to stop)')
+
+			while True:
+				time.sleep(interval)
+				changed = self.changed_files()
+				if len(changed) == 0:
+					continue
+
+				logging.info('Changed: ' + ', '.join(changed))
+				start_time = time.time()
+				try:
+					self.build(self.affected_targets(changed))
+				except Exception:
+					# A half saved card should not stop the watcher
+					logging.exception('Rebuild failed, waiting for the next change')
+				print('{:8.2f}s  rebuilt after {} changed file(s)'.format(time.time() - start_time, len(changed)))
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.shutdown()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+# Script for benchmarking the generation of medical reference cards on synthetic decks
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Generates a synthetic content tree with N cards across M domains, times each stage of
+# building the deck and the pdf:s, and compares the timings with a stored baseline:
+#
+#   python medical-reference-cards-benchmark.py --cards 1000 --domains 12 --save-baseline baseline.json
+#   python medical-reference-cards-benchmark.py --cards 1000 --domains 12 --baseline baseline.json
+
+import sys, os, argparse, logging, time, json, random, shutil, tempfile
+import MedRefCards
+
+from reportlab.pdfgen import canvas
+from reportlab.lib.units import cm
+from reportlab.lib.utils import ImageReader
+
+# Frame layouts covering the spread, single page and double-sided render paths
+DEFAULT_LAYOUTS = 'print,screen,print-double-sided'
+
+
+def generate_content_pdf(path, variant, lines, images, image_size):
+	c = canvas.Canvas(path, (10*cm, 13*cm), pageCompression = 0)
+	rng = random.Random(variant)
+
+	# Text and table rules, roughly like the Word exported cards
+	c.setFont('Helvetica', 8, leading = None)
+	for line_nr in range(lines):
+		y = 12.5*cm - (line_nr % 60) * 0.2*cm
+		c.drawString(0.3*cm, y, 'Synthetic line ' + str(line_nr) + ' ' + ' '.join(str(rng.randint(0, 999)) for word in range(8)))
+		c.line(0.2*cm, y - 0.05*cm, 9.8*cm, y - 0.05*cm)
+
+	# Raster images with noise, so that they do not compress away
+	if images > 0:
+		from PIL import Image
+		for image_nr in range(images):
+			noise = bytes(rng.getrandbits(8) for byte in range(image_size * image_size * 3))
+			image = Image.frombytes('RGB', (image_size, image_size), noise)
+			c.drawImage(ImageReader(image), 0.5*cm + image_nr * 0.5*cm, 0.5*cm, 4*cm, 4*cm)
+
+	c.showPage()
+	c.save()
+
+
+def generate_content_tree(work_path, localisation, nr_of_cards, nr_of_domains, lines, images, image_size, variants=8):
+	"""Write a synthetic contents/<localisation> tree and a matching theme, based on the card description template"""
+	content_path = os.path.join(work_path, 'contents')
+	theme_path = os.path.join(work_path, 'theme')
+	variant_path = os.path.join(work_path, 'variants')
+
+	for path in (os.path.join(content_path, localisation), os.path.join(theme_path, 'colour-schemes'), variant_path):
+		os.makedirs(path)
+
+	shutil.copytree('../theme/frame-layouts', os.path.join(theme_path, 'frame-layouts'))
+
+	# A handful of content pdf:s, copied to every card so that each card has its own file
+	variant_files = []
+	for variant in range(variants):
+		variant_file = os.path.join(variant_path, 'variant-' + str(variant) + '.pdf')
+		generate_content_pdf(variant_file, variant, lines, images, image_size)
+		variant_files.append(variant_file)
+
+	template = MedRefCards.yaml_loader('../templates/card-description-template.yml')
+	domains = ['domain ' + str(domain_nr) for domain_nr in range(nr_of_domains)]
+
+	colour_scheme = {}
+	for domain_nr, domain in enumerate(domains):
+		colour_scheme[domain] = [(domain_nr * 67) % 256, (domain_nr * 137) % 256, (domain_nr * 191) % 256]
+	MedRefCards.yaml_dump(os.path.join(theme_path, 'colour-schemes', 'default-colour-scheme.yml'), colour_scheme)
+
+	for card_nr in range(nr_of_cards):
+		domain = domains[card_nr % nr_of_domains]
+		card_fn = domain.replace(' ', '-') + '-card-' + str(card_nr)
+		card_folder = os.path.join(content_path, localisation, domain.replace(' ', '-'), card_fn)
+		os.makedirs(os.path.join(card_folder, 'source'))
+
+		card_dict = dict(template)
+		card_dict.update({
+			'domain': domain,
+			'category': 'basic' if card_nr % 3 else 'advanced',
+			'modified_date': '16' + '%02d' % (card_nr % 12 + 1) + '01',
+			'verified_date': '',
+			'verified_by': '',
+			'front_header': 'Card ' + str(card_nr) + ' Front',
+			'front_toc': ['Front section ' + str(toc_nr) for toc_nr in range(3)],
+			'front_references': ['Synthetic reference'],
+			'back_header': 'Card ' + str(card_nr) + ' Back',
+			'back_toc': ['Back section ' + str(toc_nr) for toc_nr in range(3)],
+			'back_references': ['Synthetic reference']
+		})
+		MedRefCards.yaml_dump(os.path.join(card_folder, card_fn + '.yml'), card_dict)
+
+		shutil.copyfile(variant_files[card_nr % variants], os.path.join(card_folder, card_fn + '-front.pdf'))
+		shutil.copyfile(variant_files[(card_nr + 1) % variants], os.path.join(card_folder, card_fn + '-back.pdf'))
+
+	return content_path, theme_path
+
+
+class StageTimer():
+	"""Wall time per benchmark stage"""
+	def __init__(self):
+		self.stages = {}
+		self.save_time = 0
+
+	def time(self, stage, function, *args, **kwargs):
+		start_time = time.perf_counter()
+		result = function(*args, **kwargs)
+		self.stages[stage] = time.perf_counter() - start_time
+		return result
+
+	def timed_save(self, original_save):
+		# Wraps Canvas.save, so that drawing and writing a pdf can be told apart
+		def save(c):
+			start_time = time.perf_counter()
+			original_save(c)
+			self.save_time += time.perf_counter() - start_time
+		return save
+
+
+def run_benchmark(args):
+	work_path = args.work_path or tempfile.mkdtemp(prefix='medical-reference-cards-benchmark-')
+	timer = StageTimer()
+
+	try:
+		content_path, theme_path = timer.time('generate_contents', generate_content_tree, work_path, args.localisation,
+											  args.cards, args.domains, args.lines, args.images, args.image_size)
+
+		# Resampled contents are kept in the work folder, and emptied before each render, so that they are measured cold
+		image_cache_folder = os.path.join(work_path, 'image-cache')
+		shutil.rmtree(image_cache_folder, ignore_errors=True)
+
+		med_ref_cards = timer.time('deck', MedRefCards.MedRefCards, args.localisation, 'all', content_path,
+								   args.cache_size, theme_path=theme_path, image_cache_folder=image_cache_folder)
+
+		deck = med_ref_cards.med_ref_deck
+		card_files = timer.time('discovery', deck.find_all_cards)
+		timer.time('yaml_load', lambda: [MedRefCards.yaml_loader(card_file) for card_file in card_files])
+		timer.time('sort', med_ref_cards.sort_deck)
+		timer.time('content_import', med_ref_cards.warm_content_cache)
+
+		output_path = os.path.join(work_path, 'pdf')
+		os.makedirs(os.path.join(output_path, args.localisation))
+
+		original_save = canvas.Canvas.save
+		canvas.Canvas.save = timer.timed_save(original_save)
+		try:
+			for frame_layout in args.layouts.split(','):
+				# Each render imports its contents itself, like a build in a new process, instead of
+				# drawing them from the cache that content_import and the earlier renders filled
+				med_ref_cards.content_cache = MedRefCards.MedRefContentCache(args.cache_size)
+				shutil.rmtree(image_cache_folder, ignore_errors=True)
+
+				timer.save_time = 0
+				timer.time('render_' + frame_layout, med_ref_cards.generate_pdf, frame_layout=frame_layout,
+						   output_folder=output_path, force=True)
+				timer.stages['save_' + frame_layout] = timer.save_time
+				timer.stages['draw_' + frame_layout] = timer.stages['render_' + frame_layout] - timer.save_time
+		finally:
+			canvas.Canvas.save = original_save
+
+	finally:
+		if args.work_path is None and not args.keep:
+			shutil.rmtree(work_path)
+		else:
+			print('Synthetic tree kept in: ' + work_path)
+
+	del timer.stages['generate_contents']
+
+	return {
+		'config': {'cards': args.cards, 'domains': args.domains, 'lines': args.lines, 'images': args.images,
+				   'image_size': args.image_size, 'layouts': args.layouts, 'cache_size': args.cache_size},
+		'stages': timer.stages
+	}
+
+
+def compare_with_baseline(result, baseline, threshold):
+	print('{:32} {:>10} {:>10} {:>8}'.format('stage', 'seconds', 'baseline', 'ratio'))
+	regressions = []
+	for stage, seconds in result['stages'].items():
+		baseline_seconds = baseline['stages'].get(stage) if baseline is not None else None
+		if baseline_seconds:
+			ratio = seconds / baseline_seconds
+			flag = '  slower' if ratio > threshold else ''
+			if ratio > threshold:
+				regressions.append(stage)
+			print('{:32} {:10.4f} {:10.4f} {:8.2f}{}'.format(stage, seconds, baseline_seconds, ratio, flag))
+		else:
+			print('{:32} {:10.4f} {:>10} {:>8}'.format(stage, seconds, '-', '-'))
+
+	if baseline is not None and baseline['config'] != result['config']:
+		print('Note: the baseline was recorded with a different configuration: ' + json.dumps(baseline['config']))
+
+	return regressions
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Benchmark medical reference cards on a synthetic deck.')
+	parser.add_argument(		'--cards',			action='store',			dest='cards',			default=200,	type=int,			help='number of cards')
+	parser.add_argument(		'--domains',		action='store',			dest='domains',			default=9,		type=int,			help='number of domains')
+	parser.add_argument(		'--lines',			action='store',			dest='lines',			default=40,		type=int,			help='text lines per content pdf')
+	parser.add_argument(		'--images',			action='store',			dest='images',			default=0,		type=int,			help='raster images per content pdf')
+	parser.add_argument(		'--image-size',		action='store',			dest='image_size',		default=256,	type=int,			help='width and height of each image in pixels')
+	parser.add_argument(		'--layouts',		action='store',			dest='layouts',			default=DEFAULT_LAYOUTS,			help='comma separated frame layouts')
+	parser.add_argument(		'--cache-size',		action='store',			dest='cache_size',		default=256,	type=int,			help='number of card contents kept in memory')
+	parser.add_argument('-l',	'--localisation',	action='store',			dest='localisation',	default='eng',						help='localisation')
+	parser.add_argument(		'--work-path',		action='store',			dest='work_path',		default=None,						help='folder for the synthetic tree (default: temporary)')
+	parser.add_argument(		'--keep',			action='store_true',	dest='keep',			default=False,						help='keep the synthetic tree')
+	parser.add_argument(		'--baseline',		action='store',			dest='baseline',		default=None,						help='baseline to compare with')
+	parser.add_argument(		'--save-baseline',	action='store',			dest='save_baseline',	default=None,						help='store the result as a baseline')
+	parser.add_argument(		'--threshold',		action='store',			dest='threshold',		default=1.2,	type=float,			help='ratio above which a stage counts as slower')
+	parser.add_argument(		'--output',			action='store',			dest='output',			default=None,						help='write the result as json')
+
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.ERROR)
+
+	result = run_benchmark(args)
+
+	baseline = None
+	if args.baseline is not None:
+		with open(args.baseline, 'r') as file_descriptor:
+			baseline = json.load(file_descriptor)
+
+	regressions = compare_with_baseline(result, baseline, args.threshold)
+
+	for path in (args.output, args.save_baseline):
+		if path is not None:
+			with open(path, 'w') as file_descriptor:
+				json.dump(result, file_descriptor, indent=2)
+
+	if len(regressions) > 0:
+		print('Slower than baseline: ' + ', '.join(regressions))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
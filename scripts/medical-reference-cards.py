@@ -19,8 +19,14 @@
 # Peter Alping
 # peter@alping.se
 
-import sys, argparse, getopt, logging
-import MedRefCards
+import sys, os, argparse, getopt, logging, time, json, cProfile
+
+# Only the card descriptions and the theme are read at start up. The modules that render pdf:s import
+# reportlab and pdfrw, and are imported by the commands that need them
+import MedRefDeck, MedRefFilter, MedRefProfile
+
+METADATA_COMMANDS = ('list-cards', 'list-domains', 'list-layouts', 'show')
+THEME_PATH = '../theme'
 
 def main(argv):
 	name = ''
@@ -33,23 +39,280 @@ def main(argv):
 
 
 	parser = argparse.ArgumentParser(description='Create medical reference cards.')
+	parser.add_argument(		'command',			action='store',			nargs='?',				default='build',	choices=('build', 'validate', 'convert', 'query') + METADATA_COMMANDS,	help='build the pdf:s (default), validate the cards and theme, convert stale card sources to pdf, search a built pdf, list the cards, domains or frame layouts, or show a card')
+	parser.add_argument(		'words',			action='store',			nargs='*',												help='words to search for, with query, or the card to show')
 	parser.add_argument('-n',	'--name',			action='store',			dest='name',			default='',							help='-not in use-')
 	parser.add_argument('-c',	'--colour-scheme',	action='store',			dest='colour_scheme',	default='default-colour-scheme',	help='colour scheme')
 	parser.add_argument('-f',	'--frame-layout',	action='store',			dest='frame_layout',	default='default-frame-layout',		help='frame layout')
 	parser.add_argument('-l',	'--localisation',	action='store',			dest='localisation',	default='eng',						help='localisation')
-	parser.add_argument(		'--card-filter',	action='store',			dest='card_filter',		default='all', 						help='card filter')
+	parser.add_argument(		'--localisations',	action='store',			dest='localisations',	default=None,						help='comma separated localisations, built in one run')
+	parser.add_argument(		'--all-layouts',	action='store_true',	dest='all_layouts',		default=False,						help='build every frame layout')
+	parser.add_argument('-j',	'--jobs',			action='store',			dest='jobs',			default=None,	type=int,			help='number of worker processes')
+	parser.add_argument('-v',	'--verbose',		action='store_true',	dest='verbose',			default=False,						help='report what is rebuilt, skipped and resampled, and why')
+	parser.add_argument(		'--card-filter',	action='store',			dest='card_filter',		default='all', 						help='card filter, e.g. "domain=paediatrics and verified_date>=160101"')
 	parser.add_argument(		'--content-path',	action='store',			dest='content_path',	default='../contents',				help='content path')
 	parser.add_argument(		'--output-path',	action='store',			dest='output_path',		default='../pdf',					help='output path')
+	parser.add_argument(		'--watch',			action='store_true',	dest='watch',			default=False,						help='keep running and rebuild when cards or theme files change')
+	parser.add_argument(		'--watch-interval',	action='store',			dest='watch_interval',	default=0.5,	type=float,			help='seconds between checks for changes')
+	parser.add_argument(		'--serve',			action='store',			dest='serve',			default=None,	type=int,			help='serve custom decks over http on this port')
+	parser.add_argument(		'--host',			action='store',			dest='host',			default='127.0.0.1',				help='address to serve on')
+	parser.add_argument(		'--force',			action='store_true',	dest='force',			default=False,						help='rebuild even if nothing has changed')
+	parser.add_argument(		'--optimise',		action='store_true',	dest='optimise',		default=False,						help='compress and deduplicate the output, for downloading')
+	parser.add_argument(		'--stream',			action='store',			dest='stream_pages',	default=None,	type=int,			help='render in chunks of this many pages, to keep memory flat on large decks')
+	parser.add_argument(		'--split',			action='store',			dest='split',			default=None,	choices=('card', 'domain'),	help='write one pdf per card or domain, with a manifest.json, instead of one pdf')
+	parser.add_argument(		'--prefetch',		action='store',			dest='prefetch',		default=0,		type=int,			help='number of upcoming card contents read ahead while drawing')
+	parser.add_argument(		'--cache-size',		action='store',			dest='cache_size',		default=256,	type=int,			help='number of card contents kept in memory')
+	parser.add_argument(		'--cache-file',		action='store',			dest='cache_file',		default=None,						help='file for caching card contents between runs')
+	parser.add_argument(		'--fragment-cache',	action='store',			dest='fragment_cache',	default=None,						help='folder for pre-rendered card faces')
+	parser.add_argument(		'--fragment-cache-size',	action='store',	dest='fragment_cache_size',	default=256,	type=int,			help='megabytes of pre-rendered card faces kept, the faces used longest ago are removed first')
+	parser.add_argument(		'--image-cache',	action='store',			dest='image_cache',		default=None,						help='folder for resampled card contents (default: ~/.cache/medical-reference-cards/images)')
+	parser.add_argument(		'--catalogue',		action='store',			dest='catalogue',		default=None,						help='file for keeping parsed card descriptions between runs')
+	parser.add_argument(		'--profile',		action='store',			dest='profile',			default=None,	nargs='?', const='-',	help='write a json timing report to a file (default: standard output)')
+	parser.add_argument(		'--profile-memory',	action='store_true',	dest='profile_memory',	default=False,						help='trace python allocations per stage in the --profile report (slow, so without timings)')
+	parser.add_argument(		'--profile-dump',	action='store',			dest='profile_dump',	default=None,						help='write cProfile statistics to a file')
+	parser.add_argument(		'--strict',			action='store_true',	dest='strict',			default=False,						help='fail validation on warnings too')
+	parser.add_argument(		'--converter',		action='store',			dest='converter',		default=None,						help='command converting a card source, with {source}, {outdir}, {output}, {slot} and {profile} (default: LibreOffice)')
+	parser.add_argument(		'--convert-extensions',	action='store',		dest='convert_extensions',	default=None,					help='comma separated source extensions to convert (default: .docx,.doc,.odt,.rtf)')
+	parser.add_argument(		'--conversion-manifest',	action='store',	dest='conversion_manifest',	default=None,					help='conversion manifest (default: conversion-manifest.json in the content path)')
+	parser.add_argument(		'--json',			action='store_true',	dest='json',			default=False,						help='print the lists and cards as json')
 	parser.add_argument(		'--licence',		action='store_true',	dest='licence',			default=False,						help='show licence')
 
-	args = parser.parse_args()
+	# Words may come after options too, like in: query -f print glasgow
+	args = parser.parse_intermixed_args()
+
+	logging.basicConfig(format='%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
 
 	if args.licence:
 		print('GNU General Public License (http://www.gnu.org/licenses/)')
 		return
 
-	med_ref_cards = MedRefCards.MedRefCards(args.localisation, args.card_filter, args.content_path)
-	med_ref_cards.generate_pdf(args.colour_scheme, args.frame_layout, args.output_path)
+	try:
+		MedRefFilter.MedRefCardFilter(args.card_filter)
+	except ValueError as error:
+		parser.error(str(error))
+
+	if args.command == 'validate':
+		sys.exit(validate(args))
+
+	if args.command == 'convert':
+		sys.exit(convert(args))
+
+	if args.command == 'query':
+		sys.exit(query(args))
+
+	if args.command in METADATA_COMMANDS:
+		sys.exit(metadata(args))
+
+	if args.profile is not None:
+		MedRefProfile.profiler.start(args.profile_memory)
+
+	if args.profile_dump is not None:
+		c_profile = cProfile.Profile()
+		c_profile.enable()
+
+	try:
+		build(args)
+	finally:
+		if args.profile_dump is not None:
+			c_profile.disable()
+			c_profile.dump_stats(args.profile_dump)
+
+		if args.profile is not None:
+			report = json.dumps(MedRefProfile.profiler.report(), indent=2, sort_keys=True)
+			if args.profile == '-':
+				print(report)
+			else:
+				with open(args.profile, 'w') as file_descriptor:
+					file_descriptor.write(report)
+
+
+def build(args):
+	import MedRefCards
+
+	if args.watch:
+		watch(args)
+		return
+
+	if args.serve is not None:
+		import MedRefService
+		MedRefService.serve(load_decks(args), args.host, args.serve, args.jobs)
+		return
+
+	if args.localisations is None and not args.all_layouts:
+		med_ref_cards = MedRefCards.MedRefCards(args.localisation, args.card_filter, args.content_path, args.cache_size, args.cache_file, args.fragment_cache, args.catalogue, prefetch_depth=args.prefetch, image_cache_folder=args.image_cache, fragment_folder_size=args.fragment_cache_size * 1024 * 1024)
+		med_ref_cards.generate_pdf(args.colour_scheme, args.frame_layout, args.output_path, force=args.force, optimise=args.optimise, stream_pages=args.stream_pages, split=args.split)
+		if med_ref_cards.optimisation is not None:
+			print('          ' + MedRefCards.format_optimisation(med_ref_cards.optimisation))
+		return
+
+	# Batch mode: one deck per localisation, one worker per output
+	start_time = time.time()
+
+	med_ref_cards_list = load_decks(args)
+	frame_layouts = selected_frame_layouts(args)
+	timings = MedRefCards.generate_pdfs(med_ref_cards_list, frame_layouts, args.colour_scheme, args.output_path, args.jobs, args.force, args.optimise, args.stream_pages, args.split)
+
+	for output_path, seconds, optimisation in timings:
+		print('{:8.2f}s  {}'.format(seconds, output_path))
+		if optimisation is not None:
+			print('          ' + MedRefCards.format_optimisation(optimisation))
+	print('{:8.2f}s  total ({} pdf:s)'.format(time.time() - start_time, len(timings)))
+
+
+def validate(args):
+	# Return the exit status: 1 if there are errors, or warnings when strict
+	import MedRefValidate
+
+	start_time = time.time()
+	problems = MedRefValidate.validate(localisation_list(args), args.content_path, jobs=args.jobs)
+
+	for severity, path, message in problems:
+		print(severity + ': ' + path + ': ' + message)
+
+	errors = len([problem for problem in problems if problem[0] == 'error'])
+	warnings = len(problems) - errors
+	print('{:8.2f}s  {} error(s), {} warning(s)'.format(time.time() - start_time, errors, warnings))
+
+	if errors > 0 or (args.strict and warnings > 0):
+		return 1
+	return 0
+
+
+def convert(args):
+	# Return the exit status: 1 if any conversion failed
+	import MedRefConvert
+
+	start_time = time.time()
+	converter_command = args.converter if args.converter is not None else MedRefConvert.DEFAULT_CONVERTER
+	extensions = args.convert_extensions.split(',') if args.convert_extensions is not None else MedRefConvert.DEFAULT_EXTENSIONS
+	converter = MedRefConvert.MedRefConverter(args.content_path, localisation_list(args), converter_command, extensions,
+											  args.conversion_manifest, args.jobs)
+	results = converter.run(args.force)
+
+	failed = 0
+	for source, content_pdf, seconds, error in results:
+		if error is not None:
+			print('  failed  ' + source + ': ' + error)
+			failed += 1
+		else:
+			print('{:8.2f}s  {}'.format(seconds, content_pdf))
+	print('{:8.2f}s  {} converted, {} failed'.format(time.time() - start_time, len(results) - failed, failed))
+
+	return 1 if failed > 0 else 0
+
+
+def query(args):
+	# Search the index of the pdf for the frame layout and localisation, and return the exit status: 1 if nothing matched
+	import MedRefSearch
+
+	index_path = os.path.join(args.output_path, args.localisation, 'medical-reference-cards-' + args.frame_layout + '-' + args.localisation + '.index.json')
+	if not os.path.isfile(index_path):
+		print('No search index: ' + index_path + '. Build the pdf first.')
+		return 1
+
+	index = MedRefSearch.MedRefSearchIndex.load(index_path)
+	start_time = time.perf_counter()
+	results = index.query(' '.join(args.words))
+	seconds = time.perf_counter() - start_time
+
+	for page, card, side in results:
+		print('{:6}  {:5}  {}  ({})'.format(page, side, card[side + '_header'], card['domain']))
+	print('{} match(es) in {}, {:.3f} ms'.format(len(results), index.pdf_name, seconds * 1000))
+
+	return 0 if len(results) > 0 else 1
+
+
+def metadata(args):
+	# Answer list-cards, list-domains, list-layouts and show from the card descriptions and theme alone, and return the exit status
+	if args.command == 'list-layouts':
+		layouts = []
+		for name in MedRefDeck.list_frame_layouts(THEME_PATH):
+			frame_layout = MedRefDeck.set_frame_layout(MedRefDeck.yaml_loader(os.path.join(THEME_PATH, 'frame-layouts', name + '.yml')))
+			layouts.append({'name': name, 'output': frame_layout['output'], 'card_width': frame_layout['card']['width'], 'card_height': frame_layout['card']['height']})
+		print_rows(args, layouts, ('name', 'output', 'card_width', 'card_height'))
+		return 0
+
+	if args.command == 'show' and len(args.words) != 1:
+		print('Name the card to show, e.g.: show medicine-af-chadsvas', file=sys.stderr)
+		return 2
+
+	catalogue = MedRefDeck.MedRefCatalogue(args.catalogue)
+	rows = []
+	for localisation in localisation_list(args):
+		med_ref_deck = MedRefDeck.MedRefDeck(localisation, args.card_filter, args.content_path, catalogue)
+		med_ref_deck.sort()
+
+		if args.command == 'list-cards':
+			for card in med_ref_deck.cards:
+				rows.append({'localisation': localisation, 'id': card.card_fn, 'domain': card.domain, 'category': card.category,
+							 'front_header': card.front_face.header, 'back_header': card.back_face.header})
+
+		elif args.command == 'list-domains':
+			for domain in med_ref_deck.domain_index:
+				domain_cards = [card for card in med_ref_deck.cards if card.domain == domain]
+				rows.append({'localisation': localisation, 'domain': domain, 'cards': len(domain_cards),
+							 'categories': ','.join(sorted(set(card.category for card in domain_cards)))})
+
+		elif args.words[0] in med_ref_deck.card_positions:
+			card = med_ref_deck.cards[med_ref_deck.card_positions[args.words[0]]]
+			shown = {'localisation': localisation, 'id': card.card_fn, 'card_file': card.card_file,
+					 'front_content': card.front_face.content_path, 'back_content': card.back_face.content_path}
+			shown.update(card.card_dict)
+			rows.append(shown)
+
+	if args.command == 'list-cards':
+		print_rows(args, rows, ('localisation', 'id', 'domain', 'category', 'front_header', 'back_header'))
+	elif args.command == 'list-domains':
+		print_rows(args, rows, ('localisation', 'domain', 'cards', 'categories'))
+	elif len(rows) == 0:
+		print('No such card: ' + args.words[0], file=sys.stderr)
+		return 1
+	elif args.json:
+		print(json.dumps(rows if len(rows) > 1 else rows[0], indent=2, default=str))
+	else:
+		first_keys = ('localisation', 'id', 'card_file', 'front_content', 'back_content')
+		for shown in rows:
+			for key in first_keys + tuple(sorted(set(shown) - set(first_keys))):
+				value = shown[key]
+				print('{:18} {}'.format(key + ':', '; '.join(value) if isinstance(value, list) else value))
+			print()
+
+	return 0
+
+
+def print_rows(args, rows, columns):
+	# One tab separated line per row, for scripts, or a json list
+	if args.json:
+		print(json.dumps(rows, indent=2, default=str))
+		return
+	for row in rows:
+		print('\t'.join(str(row[column]) for column in columns))
+
+
+def watch(args):
+	import MedRefWatch
+
+	watcher = MedRefWatch.MedRefWatcher(load_decks(args), selected_frame_layouts(args), args.colour_scheme, args.output_path, args.optimise)
+	watcher.run(args.watch_interval)
+
+
+def localisation_list(args):
+	if args.localisations is not None:
+		return [localisation.strip() for localisation in args.localisations.split(',') if localisation.strip() != '']
+	return [args.localisation]
+
+
+def load_decks(args):
+	import MedRefCards
+
+	return [MedRefCards.MedRefCards(localisation, args.card_filter, args.content_path, args.cache_size, args.cache_file, args.fragment_cache, args.catalogue, prefetch_depth=args.prefetch, image_cache_folder=args.image_cache, fragment_folder_size=args.fragment_cache_size * 1024 * 1024) for localisation in localisation_list(args)]
+
+
+def selected_frame_layouts(args):
+	if args.all_layouts:
+		return MedRefDeck.list_frame_layouts(THEME_PATH)
+	return [args.frame_layout]
+
 
 if __name__ == "__main__":
 	main(sys.argv[1:])
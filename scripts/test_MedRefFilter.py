@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+# Tests of the card filter expressions of medical reference cards
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Run with: python -m unittest test_MedRefFilter (from the scripts folder)
+
+import unittest
+
+from MedRefFilter import MedRefCardFilter, MedRefCardIndex
+
+
+def card_dict(domain, category, verified_date='', verified_by='', front_header='', front_toc=None):
+	return {
+		'domain': domain, 'category': category, 'modified_date': '160101',
+		'verified_date': verified_date, 'verified_by': verified_by,
+		'front_header': front_header, 'front_toc': front_toc or [], 'back_header': '', 'back_toc': []
+	}
+
+
+CARDS = [
+	card_dict('neurology', 'basic', '160301', 'PA', 'Glasgow Coma Scale'),
+	card_dict('neurology', 'advanced', '', '', 'NIHSS'),
+	card_dict('obstetrics and gynaecology', 'basic', '151201', 'PA', 'Bishop Score'),
+	card_dict('paediatrics', 'advanced', '160101', '', 'Paediatric Vitals', ['Glasgow Coma Scale, paediatric']),
+	card_dict('orthopaedics', 'basic', '', '', 'Ottawa Ankle Rules')
+]
+
+
+class CardFilterTest(unittest.TestCase):
+	"""Cards selected by filter expressions, by position in CARDS"""
+
+	def setUp(self):
+		self.card_index = MedRefCardIndex(CARDS)
+
+	def select(self, expression):
+		return MedRefCardFilter(expression).select(self.card_index)
+
+	def test_all(self):
+		self.assertEqual(self.select('all'), [0, 1, 2, 3, 4])
+
+	def test_precedence(self):
+		# not binds tighter than and, which binds tighter than or
+		self.assertEqual(self.select('domain=orthopaedics or domain=neurology and category=basic'), [0, 4])
+		self.assertEqual(self.select('(domain=orthopaedics or domain=neurology) and category=basic'), [0, 4])
+		self.assertEqual(self.select('not domain=neurology and category=basic'), [2, 4])
+		self.assertEqual(self.select('not (domain=neurology and category=basic)'), [1, 2, 3, 4])
+
+	def test_keywords_ignore_case(self):
+		self.assertEqual(self.select('DOMAIN=Neurology AND NOT category=basic'), [1])
+
+	def test_quoted_values(self):
+		self.assertEqual(self.select("domain='obstetrics and gynaecology'"), [2])
+		self.assertEqual(self.select('domain="Obstetrics and Gynaecology" or domain=orthopaedics'), [2, 4])
+		self.assertEqual(self.select("verified_by=''"), [1, 3, 4])
+
+	def test_comma_lists(self):
+		self.assertEqual(self.select('domain=neurology,orthopaedics'), [0, 1, 4])
+		self.assertEqual(self.select('domain!=neurology,orthopaedics'), [2, 3])
+
+	def test_contains(self):
+		self.assertEqual(self.select('header~glasgow'), [0])
+		self.assertEqual(self.select('text~glasgow'), [0, 3])
+
+	def test_ordered_comparisons_skip_empty_values(self):
+		self.assertEqual(self.select('verified_date>=160101'), [0, 3])
+		self.assertEqual(self.select('verified_date<160101'), [2])
+		self.assertEqual(self.select('verified_date<=160301'), [0, 2, 3])
+		self.assertEqual(self.select('verified_date>151201'), [0, 3])
+
+	def test_errors(self):
+		for expression in ('domain=', '(domain=x', 'domain=x)', 'colour=red', 'domain neurology', 'domain=x and', 'domain=x @'):
+			with self.assertRaises(ValueError, msg=expression):
+				MedRefCardFilter(expression)
+
+	def test_error_messages(self):
+		with self.assertRaisesRegex(ValueError, 'Unexpected end'):
+			MedRefCardFilter('domain=')
+		with self.assertRaisesRegex(ValueError, r'Missing \)'):
+			MedRefCardFilter('(domain=x')
+		with self.assertRaisesRegex(ValueError, r'Missing \)'):
+			MedRefCardFilter('(domain=x or domain=y category=basic')
+		with self.assertRaisesRegex(ValueError, 'Unknown card field'):
+			MedRefCardFilter('colour=red')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+# Tests of the imposition of medical reference cards on printed sheets
+# Copyright (C) 2016 Peter Alping
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Peter Alping
+# peter@alping.se
+
+# Run with: python -m unittest test_MedRefImposition (from the scripts folder)
+
+import unittest
+
+from MedRefImposition import MedRefImposition
+
+
+def frame_layout(sheet, duplex, spreads=False):
+	return {
+		'card': {'width': 10, 'height': 15},
+		'imposition': {'sheet': sheet, 'margin': 0, 'duplex': duplex, 'spreads': spreads, 'cut_marks': False}
+	}
+
+
+class PositionsTest(unittest.TestCase):
+	"""Each back lands behind its front once the sheet is turned over the duplex edge"""
+
+	# 2 x 2 cards on an upright sheet, 4 x 2 cards on a turned sheet
+	PORTRAIT = [21, 31]
+	LANDSCAPE = [40, 31]
+
+	def assertBehind(self, imposition, over_side_edge):
+		for front, back in zip(imposition.positions(1), imposition.positions(2)):
+			if over_side_edge:
+				expected = (imposition.sheet_width - front[0] - imposition.card_width, front[1])
+			else:
+				expected = (front[0], imposition.sheet_height - front[1] - imposition.card_height)
+			self.assertAlmostEqual(back[0], expected[0], places=6)
+			self.assertAlmostEqual(back[1], expected[1], places=6)
+
+	def test_orientation(self):
+		portrait = MedRefImposition(frame_layout(self.PORTRAIT, 'long-edge'))
+		self.assertGreater(portrait.sheet_height, portrait.sheet_width)
+		self.assertEqual((portrait.columns, portrait.rows), (2, 2))
+
+		landscape = MedRefImposition(frame_layout(self.LANDSCAPE, 'long-edge'))
+		self.assertGreater(landscape.sheet_width, landscape.sheet_height)
+		self.assertEqual((landscape.columns, landscape.rows), (4, 2))
+
+	def test_portrait_long_edge(self):
+		imposition = MedRefImposition(frame_layout(self.PORTRAIT, 'long-edge'))
+		self.assertTrue(imposition.mirror_columns)
+		self.assertFalse(imposition.rotate_backs)
+		self.assertBehind(imposition, over_side_edge=True)
+
+	def test_portrait_short_edge(self):
+		imposition = MedRefImposition(frame_layout(self.PORTRAIT, 'short-edge'))
+		self.assertFalse(imposition.mirror_columns)
+		self.assertTrue(imposition.rotate_backs)
+		self.assertBehind(imposition, over_side_edge=False)
+
+	def test_landscape_long_edge(self):
+		imposition = MedRefImposition(frame_layout(self.LANDSCAPE, 'long-edge'))
+		self.assertFalse(imposition.mirror_columns)
+		self.assertTrue(imposition.rotate_backs)
+		self.assertBehind(imposition, over_side_edge=False)
+
+	def test_landscape_short_edge(self):
+		imposition = MedRefImposition(frame_layout(self.LANDSCAPE, 'short-edge'))
+		self.assertTrue(imposition.mirror_columns)
+		self.assertFalse(imposition.rotate_backs)
+		self.assertBehind(imposition, over_side_edge=True)
+
+	def test_spreads(self):
+		imposition = MedRefImposition(frame_layout(self.LANDSCAPE, 'short-edge', spreads=True))
+		self.assertFalse(imposition.rotate_backs)
+		self.assertEqual(imposition.positions(1), imposition.positions(2))
+
+	def test_default_sheet(self):
+		# Without an imposition section: four cards on a sheet twice the size of a card, turned over the long edge
+		imposition = MedRefImposition({'card': {'width': 10.5, 'height': 14.8}})
+		self.assertEqual((imposition.columns, imposition.rows), (2, 2))
+		self.assertFalse(imposition.rotate_backs)
+		self.assertBehind(imposition, over_side_edge=True)
+
+
+if __name__ == '__main__':
+	unittest.main()